@@ -5,7 +5,10 @@
 # ID: 1651034
 # CSE 143 Assignment 1
 import nltk, zipfile, argparse, sys
+from collections import Counter
 from contextlib import redirect_stdout
+from nltk.collocations import BigramAssocMeasures, BigramCollocationFinder
+from nltk.util import tokenwrap
 
 ###############################################################################
 ## Utility Functions ##########################################################
@@ -22,9 +25,100 @@ from contextlib import redirect_stdout
 # Finally, we read the raw contents of the file:
 #     zip_archive.open(fn, 'rU').read()
 def unzip_corpus(input_file):
-	zip_archive = zipfile.ZipFile(input_file)
-	contents = [zip_archive.open(fn, 'r').read().decode('utf-8') for fn in zip_archive.namelist() if fn.endswith(".txt") and not fn.startswith('__MACOSX')]
-	return contents
+	return list(iter_corpus(input_file))
+
+
+# Same as unzip_corpus, but yields the documents one at a time so only one of
+# them is in memory at once.
+def iter_corpus(input_file):
+	with zipfile.ZipFile(input_file) as zip_archive:
+		for fn in zip_archive.namelist():
+			if fn.endswith(".txt") and not fn.startswith('__MACOSX'):
+				with zip_archive.open(fn, 'r') as f:
+					yield f.read().decode('utf-8')
+
+
+# Gathers every statistic process_corpus reports from a single pass over the
+# part-of-speech tagged sentences of the corpus, in the order they appear.
+# Only counts are kept, never the tokens themselves:
+#     corpus_length     the total number of tokens
+#     vocabulary        the set of lowercased words
+#     word_dist         FreqDist of the words
+#     tag_dist          FreqDist of the part-of-speech tags
+#     pos_word_dist     ConditionalFreqDist of the words given their tag
+# plus what nltk.Text builds from the whole token list for similar() and
+# collocation_list(): the bigram counts, and the (left, right) contexts of
+# every alphabetic word among the alphabetic words.
+# The sentences are counted with Counter.update, which runs in C; the
+# distributions are made from the counts by finish(), in the order the
+# words were first seen so that ties come out as they would from nltk.Text.
+class CorpusStats:
+	def __init__(self):
+		self.corpus_length = 0
+		self.vocabulary = set()
+		self.word_dist = nltk.FreqDist()
+		self.tag_dist = nltk.FreqDist()
+		self.pos_word_dist = nltk.ConditionalFreqDist()
+		self.bigram_dist = nltk.FreqDist()
+		self.word_contexts = nltk.ConditionalFreqDist()
+		self._tagged_words = Counter()
+		self._bigrams = Counter()
+		self._contexts = Counter()
+		self._previous_word = []
+		# a word's context is only known once the next alphabetic word is seen
+		self._context_words = ["*START*"]
+
+	def add_sentence(self, tagged_sentence):
+		words = [word for (word, tag) in tagged_sentence]
+		self.corpus_length += len(words)
+		self._tagged_words.update(tagged_sentence)
+		self._bigrams.update(zip(self._previous_word + words, words))
+		self._previous_word = words[-1:] or self._previous_word
+		alpha_words = [word.lower() for word in words if word.isalpha()]
+		if alpha_words:
+			self._add_contexts(alpha_words)
+
+	def _add_contexts(self, alpha_words):
+		# the context of word i is (word i - 1, word i + 1)
+		context_words = self._context_words + alpha_words
+		self._contexts.update(zip(context_words[1:-1], zip(context_words, context_words[2:])))
+		self._context_words = context_words[-2:]
+
+	# Call once the whole corpus has been added.
+	def finish(self):
+		if len(self._context_words) > 1:
+			self._add_contexts(["*END*"])
+		for (word, tag), count in self._tagged_words.items():
+			self.vocabulary.add(word.lower())
+			self.word_dist[word] += count
+			self.tag_dist[tag] += count
+			self.pos_word_dist[tag][word] += count
+		self.bigram_dist.update(self._bigrams)
+		for (word, context), count in self._contexts.items():
+			self.word_contexts[word][context] = count
+		self._tagged_words = self._bigrams = self._contexts = None
+
+	# Same as nltk.Text(tokens).similar(word)
+	def similar(self, word, num=20):
+		word = word.lower()
+		wci = self.word_contexts
+		if word in wci.conditions():
+			contexts = set(wci[word])
+			fd = nltk.FreqDist(w for w in wci.conditions() for c in wci[w] if c in contexts and not w == word)
+			words = [w for w, _ in fd.most_common(num)]
+			print(tokenwrap(words))
+		else:
+			print("No matches")
+
+	# Same as nltk.Text(tokens).collocation_list(), with each collocation as
+	# a "word1 word2" string like older versions of nltk return
+	def collocation_list(self, num=20):
+		from nltk.corpus import stopwords
+		ignored_words = stopwords.words("english")
+		finder = BigramCollocationFinder(self.word_dist, self.bigram_dist)
+		finder.apply_freq_filter(2)
+		finder.apply_word_filter(lambda w: len(w) < 3 or w.lower() in ignored_words)
+		return [w1 + " " + w2 for (w1, w2) in finder.nbest(BigramAssocMeasures().likelihood_ratio, num)]
 
 
 ###############################################################################
@@ -32,62 +126,44 @@ def unzip_corpus(input_file):
 ###############################################################################
 def process_corpus(corpus_name):
 	input_file = corpus_name + ".zip"
-	corpus_contents = unzip_corpus(input_file)
 
 	##################
 	#  Tokenization  #
 	##################
 	#	Write name of corpus to `stdout`
 	print("Corpus name: " + corpus_name, file=sys.stdout)
-	
-	#	Delimit the sentences for each document in the corpus.
-	tokenized_sentences = [nltk.sent_tokenize(sent) for sent in corpus_contents]
-
-	#	Tokenize the words in each sentence of each document.
-	#		`tokenized_words[0]` is the first document in the corpus
-	#		`tokenized_words[0][0]` is the first sentence of the first document in the corpus
-	#		`tokenized_words[0][0][0]` is the first word of the first sentence of the first document in the corpus
-	tokenized_words = []
-	corpus_length = 0
-	for document in tokenized_sentences:
-		temp = []
-		for sentences in document:
-			result = nltk.word_tokenize(sentences)
-			temp.append(result)
-			corpus_length += len(result)
-		tokenized_words.append(temp)
-	
-	# Count the number of total words in the corpus and write the result to `stdout`.
-	#	corpus_length calculated in previous step for convenience
-	#	lowercase is irrelevant in this step because we want total tokens in corpus, not unique, so no need to account for duplicates
-	print("Total words in the corpus: " + str(corpus_length), file=sys.stdout)
 
-	####################
-	#  Part-of-Speech  #
-	####################
+	#	Read the documents one at a time, delimit the sentences of each, tokenize
+	#	the words in each sentence and tag them, all exactly once. Every
+	#	statistic below comes from this single pass.
+	#
 	#	Apply the default part-of-speech tagger to each tokenized sentence
 	# 	Write a file named CORPUS NAME-pos.txt that has each part-of-speech tagged sentence on a separate line and a blank newline separating documents. Where CORPUS NAME is either fables or blogs. The format of the tagging should be a word-tag pair with a / in between. For example: The/DT boy/NN jumped/VBD ./.
+	stats = CorpusStats()
 	filename = corpus_name + "-pos.txt"
 	with open(filename, "w+") as f:
-		for document in tokenized_words:
-			for sentence in document:
-				result = nltk.pos_tag(sentence)
+		for document in iter_corpus(input_file):
+			for sentence in nltk.sent_tokenize(document):
+				result = nltk.pos_tag(nltk.word_tokenize(sentence))
+				stats.add_sentence(result)
 				for token in result:
 					print((token[0] + "/" + token[1]), file=f, end=' ')
 			print('\n', file=f)
+	stats.finish()
+	corpus_length = stats.corpus_length
+
+	# Count the number of total words in the corpus and write the result to `stdout`.
+	#	lowercase is irrelevant in this step because we want total tokens in corpus, not unique, so no need to account for duplicates
+	print("Total words in the corpus: " + str(corpus_length), file=sys.stdout)
 
 	###############
 	#  Frequency  #
 	###############
 	# Write the vocabulary size of corpus to `stdout`. Please note that you should use the lowercased word
-	vocabulary  = []
-	for document in tokenized_sentences:
-		for sentence in document:
-			vocabulary.extend(nltk.word_tokenize(sentence))
-	print("Vocabulary size of the corpus: " + str(len(set([word.lower() for word in vocabulary]))), file=sys.stdout)
+	print("Vocabulary size of the corpus: " + str(len(stats.vocabulary)), file=sys.stdout)
 
 	# Write the most frequent part-of-speech tag and its frequency to the stdout.
-	dist = nltk.FreqDist(tag for (word, tag) in nltk.pos_tag(vocabulary))
+	dist = stats.tag_dist
 	print("The most frequent part-of-speech tag is " + dist.most_common(1)[0][0] + " with frequency " + str(dist.most_common(1)[0][1]), file=sys.stdout)
 
 	# Write down the top 10 most frequent part-of-speech tags in the corpus with their frequency and relative frequency to the stdout in a decreasing order of frequency. Relative frequency should be rounded to 3 digits and can be computed by dividing the frequency by the total number of tokens in the corpus.
@@ -97,15 +173,14 @@ def process_corpus(corpus_name):
 	print('and finally, ' + dist.most_common(10)[9][0] + " has frequency " + str(dist.most_common(10)[9][1]) + " and relative frequency " + "{:.2e}".format(round(dist.most_common(10)[9][1]/corpus_length, 3)), file=sys.stdout)
 
 	# Find the frequency of each unique word (after lowercasing) using the FreqDist module and write the list in decreasing order to a file named CORPUS NAME-word-freq.txt.
-	dist = nltk.FreqDist(vocabulary)
+	dist = stats.word_dist
 	filename = corpus_name + "-word-freq.txt"
 	with open(filename, "w+") as f:
 		for token in list(dist.most_common()):	
 			print(token[0] + " has frequency " + str(token[1]), file=f)
 
 	# Find the frequency of each word given its part-of-speech tag. Use a conditional frequency distribution for this (CondFreqDist) where the first item in the pair is the part-of-speech and the second item is the lowercased word. Note, the part-of-speech tagger requires uppercase words and returns the word/tag pair in the inverse order of what we are asking here. Use the tabulate() method of the CondFreqDist class to write the results to a file named CORPUS NAME-pos-word-freq.txt.
-	part_of_speeches = nltk.pos_tag(vocabulary)
-	dist = nltk.ConditionalFreqDist((tag, word) for (word, tag) in part_of_speeches)
+	dist = stats.pos_word_dist
 	filename = corpus_name + "-pos-word-freq.txt"
 	with open(filename, 'w+') as f:
 	    with redirect_stdout(f):
@@ -115,25 +190,25 @@ def process_corpus(corpus_name):
 	#  Similar Words  #
 	###################
 	# For the most frequent word in the NN (nouns), VBD (past-tense verbs), JJ (adjectives) and RB (adverbs) part-of-speech tags, find the most similar words using Text.similar(). Write the output to stdout (this will happen by default).
+	#	CorpusStats.similar() does the same as Text.similar() without needing every token in memory
 	noun_most_freq = dist['NN'].most_common(1)[0][0]
 	past_tense_verb_most_freq = dist['VBD'].most_common(1)[0][0]
 	adjective_most_freq = dist['JJ'].most_common(1)[0][0]
 	adverb_most_freq = dist['RB'].most_common(1)[0][0]
-	corpus_text = nltk.Text(vocabulary)
 	print("The most frequent word in the NN category is: \'" + noun_most_freq + "\' and its similar words are: ", end='')
-	corpus_text.similar(noun_most_freq)
+	stats.similar(noun_most_freq)
 	print("The most frequent word in the VBD category is: \'" + past_tense_verb_most_freq + "\' and its similar words are: ", end='')
-	corpus_text.similar(past_tense_verb_most_freq)
+	stats.similar(past_tense_verb_most_freq)
 	print("The most frequent word in the JJ category is: \'" + adjective_most_freq + "\' and its similar words are: ", end='')
-	corpus_text.similar(adjective_most_freq)
+	stats.similar(adjective_most_freq)
 	print("The most frequent word in the RB category is: \'" + adverb_most_freq + "\' and its similar words are: ", end='')
-	corpus_text.similar(adverb_most_freq)
+	stats.similar(adverb_most_freq)
 
 	##################
 	#  Collocations  #
 	##################
 	# Write the collocations to the stdout.
-	print("Collocations: " + ', '.join(corpus_text.collocation_list()), file=sys.stdout)
+	print("Collocations: " + ', '.join(stats.collocation_list()), file=sys.stdout)
 
 
 ###############################################################################
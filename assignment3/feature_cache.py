@@ -0,0 +1,73 @@
+import hashlib
+import pickle
+import sqlite3
+import zlib
+
+
+class FeatureCache(object):
+	"""
+	An on-disk cache of extracted features, shared between runs.
+
+	Entries are addressed by the text itself (its SHA-1), the name of the
+	extractor that produced them (e.g. "ngram", "pos", "liwc") and the
+	extractor version, so changing an extractor only needs a new version
+	number for stale entries to be ignored. Feature dictionaries are stored
+	pickled and zlib compressed in a single SQLite file.
+
+	with FeatureCache("features.cache", version=1) as cache:
+		features = cache.get_or_compute(text, "ngram", lambda: get_ngram_features(words))
+	"""
+
+	def __init__(self, path, version, commit_every=1000):
+		self.path = path
+		self.version = version
+		self.commit_every = commit_every
+		self.hits = 0
+		self.misses = 0
+		self._uncommitted = 0
+		self._connection = sqlite3.connect(path)
+		self._connection.execute("CREATE TABLE IF NOT EXISTS features (key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+
+	def key(self, text, extractor):
+		digest = hashlib.sha1("{}\0{}\0".format(extractor, self.version).encode("utf-8"))
+		digest.update(text.encode("utf-8"))
+		return digest.digest()
+
+	def get(self, text, extractor):
+		"""
+		:return: the cached feature dictionary, or None
+		"""
+		row = self._connection.execute("SELECT value FROM features WHERE key = ?", (self.key(text, extractor),)).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return pickle.loads(zlib.decompress(row[0]))
+
+	def put(self, text, extractor, features):
+		value = zlib.compress(pickle.dumps(features, protocol=pickle.HIGHEST_PROTOCOL))
+		self._connection.execute("INSERT OR REPLACE INTO features (key, value) VALUES (?, ?)", (self.key(text, extractor), value))
+		self._uncommitted += 1
+		if self._uncommitted >= self.commit_every:
+			self.commit()
+
+	def get_or_compute(self, text, extractor, compute):
+		features = self.get(text, extractor)
+		if features is None:
+			features = compute()
+			self.put(text, extractor, features)
+		return features
+
+	def commit(self):
+		self._connection.commit()
+		self._uncommitted = 0
+
+	def close(self):
+		self.commit()
+		self._connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
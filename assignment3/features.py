@@ -3,12 +3,108 @@ import re
 import word_category_counter
 import data_helper
 import os, sys
+import multiprocessing
+import zlib
+from collections import Counter, namedtuple
 
 DATA_DIR = "data"
 LIWC_DIR = "liwc"
 
 word_category_counter.load_dictionary(LIWC_DIR)
 
+class Normalizer(object):
+	"""
+	Text normalization with its word lists and stemmer set up once.
+
+	A token is lowercased (if lowercase), dropped if it is a stopword or has
+	no word characters (if drop_punctuation) and finally stemmed (if a
+	stemmer is given). The defaults match what normalize has always done.
+
+	Normalizers can be pickled, e.g. to send them to worker processes, the
+	stemmer is rebuilt from its name.
+
+	:param lowercase: bool
+	:param stopwords: a language for nltk.corpus.stopwords, a collection of
+		words, or None to keep stopwords
+	:param drop_punctuation: bool
+	:param stemmer: None, "porter", "lancaster" or "snowball" (english)
+	"""
+
+	_word_character = re.compile(r"\w")
+
+	def __init__(self, lowercase=True, stopwords="english", drop_punctuation=True, stemmer=None):
+		self.lowercase = lowercase
+		if isinstance(stopwords, str):
+			stopwords = nltk.corpus.stopwords.words(stopwords)
+		self.stopwords = frozenset(stopwords) if stopwords is not None else frozenset()
+		self.drop_punctuation = drop_punctuation
+		self.stemmer = stemmer
+		self._stem = self._build_stemmer(stemmer)
+
+	@staticmethod
+	def _build_stemmer(stemmer):
+		if stemmer is None:
+			return None
+		elif stemmer == "porter":
+			return nltk.stem.PorterStemmer().stem
+		elif stemmer == "lancaster":
+			return nltk.stem.LancasterStemmer().stem
+		elif stemmer == "snowball":
+			return nltk.stem.SnowballStemmer("english").stem
+		raise ValueError("unrecognized stemmer:{}, Accepted values: None, porter, lancaster, snowball".format(stemmer))
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["_stem"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._stem = self._build_stemmer(self.stemmer)
+
+	def normalize(self, token):
+		"""
+		:param token: str: the word to normalize
+		:return: None or str
+		"""
+		normalized_token = token.lower() if self.lowercase else token
+		if normalized_token.lower() in self.stopwords:
+			return None
+		if self.drop_punctuation and self._word_character.search(normalized_token) is None:
+			return None
+		if self._stem is not None:
+			normalized_token = self._stem(normalized_token)
+		return normalized_token
+
+	def normalize_tokens(self, tokens):
+		"""
+		Normalizes a list of tokens, the dropped ones are left out.
+
+		:param tokens: list of str
+		:return: list of str
+		"""
+		normalized_tokens = []
+		for token in tokens:
+			normalized_token = self.normalize(token)
+			if normalized_token is not None:
+				normalized_tokens.append(normalized_token)
+		return normalized_tokens
+
+
+# The Normalizer used by normalize and the feature extractors, see get_normalizer
+_normalizer = None
+
+
+def get_normalizer():
+	"""
+	:return: the default Normalizer, built on first use
+	"""
+	global _normalizer
+	if _normalizer is None:
+		_normalizer = Normalizer()
+	return _normalizer
+
+
 def normalize(token, should_normalize=True):
 	"""
 	This function performs text normalization.
@@ -27,10 +123,7 @@ def normalize(token, should_normalize=True):
 		normalized_token = token
 
 	else:
-		stop_words = set(nltk.corpus.stopwords.words('english'))
-		normalized_token = token.lower()
-		if normalized_token in stop_words or re.search(r"\w+", normalized_token) == None:
-			return None
+		normalized_token = get_normalizer().normalize(token)
 	return normalized_token
 
 
@@ -51,54 +144,127 @@ def get_words_tags(text, should_normalize=True):
 	:param should_normalize:
 	:return:
 	"""
-	words = []
-	tags = []
+	annotated_text = annotate_text(text)
+	return annotated_text.words, annotated_text.tags
+
+
+# A review tokenized and tagged once, for all the feature extractors
+# sentences is a list of lists of words, words and tags are flat
+AnnotatedText = namedtuple("AnnotatedText", ["text", "sentences", "words", "tags"])
+
+
+def annotate_text(text):
+	"""
+	Splits a text into sentences, word tokenizes each sentence and part of
+	speech tags the words.
 
-	sentences = nltk.sent_tokenize(text)
-	words.extend(nltk.word_tokenize(text))
+	The words are the same as nltk.word_tokenize(text) and are tagged
+	together, as get_words_tags always did.
+
+	:param text: str
+	:return: AnnotatedText
+	"""
+	sentences = [nltk.word_tokenize(sentence, preserve_line=True) for sentence in nltk.sent_tokenize(text)]
+	words = [word for sentence in sentences for word in sentence]
 	tags = [tag for (word, tag) in nltk.pos_tag(words)]
-	return words, tags
+	return AnnotatedText(text, sentences, words, tags)
 
 
-def get_ngram_features(tokens):
+def annotate_corpus(category_text_dict):
 	"""
-	This function creates the unigram and bigram features as described in
-	the assignment3 handout.
+	Annotates every text of a dataset once, so get_features_category_tuples
+	can be called for several feature sets without tokenizing and tagging
+	again.
 
-	:param tokens:
-	:return: feature_vectors: a dictionary values for each ngram feature
+	:param category_text_dict: category -> list of texts
+	:return: category -> list of AnnotatedText, in the same order
 	"""
-	feature_vectors = {}
-	tokens = [normalize(token) for token in tokens if normalize(token) != None]
-	
-	token_unigrams = list(nltk.ngrams(tokens, 1))
-	token_bigrams = list(nltk.ngrams(tokens, 2))
-	token_trigrams = list(nltk.ngrams(tokens, 3))
-	
-	num_uni = len(token_unigrams)
-	num_bi = len(token_bigrams)
-	num_tri = len(token_trigrams)
+	return {category: [annotate_text(text) for text in texts] for category, texts in category_text_dict.items()}
 
-	uni_dist = nltk.FreqDist(token_unigrams)
-	bi_dist = nltk.FreqDist(token_bigrams)
-	tri_dist = nltk.FreqDist(token_trigrams)
 
-	for sample in uni_dist.most_common():
-		sample_key = "UNI_" + sample[0][0]
-		sample_value = sample[1] / num_uni
-		feature_vectors[sample_key] = sample_value
+class NgramFeaturizer(object):
+	"""
+	Counts the n-grams of every order in one pass over a token sequence.
+
+	Feature names are the order's name (UNI, BIGRAM, TRIGRAM, then 4GRAM,
+	5GRAM...), the label, then the n-gram joined with "_", e.g.
+	"BIGRAM_good_movie" or, with label="_POS" and uppercase=True,
+	"TRIGRAM_POS_DT_JJ_NN".
+
+	:param orders: the n-gram orders to count, e.g. (1, 2, 3)
+	:param label: added after the order's name
+	:param uppercase: uppercase the n-grams in feature names
+	:param relative: values are the count divided by the number of n-grams
+		of that order in the sequence (as the extractors have always done),
+		otherwise the raw counts
+	:param hashed: use a stable 32 bit hash (CRC32) of each feature name
+		as its key instead of the name
+	"""
 
-	for sample in bi_dist.most_common():
-		sample_key = "BIGRAM_" + "_".join(sample[0])
-		sample_value = sample[1] / num_bi
-		feature_vectors[sample_key] = sample_value
+	ORDER_NAMES = {1: "UNI", 2: "BIGRAM", 3: "TRIGRAM"}
+
+	def __init__(self, orders=(1, 2, 3), label="", uppercase=False, relative=True, hashed=False):
+		self.orders = tuple(sorted(set(orders)))
+		if not self.orders or self.orders[0] < 1:
+			raise ValueError("orders must be positive n-gram orders, not {}".format(orders))
+		self.label = label
+		self.uppercase = uppercase
+		self.relative = relative
+		self.hashed = hashed
+		self._prefixes = {n: self.ORDER_NAMES.get(n, "{}GRAM".format(n)) + label + "_" for n in self.orders}
+
+	def count(self, tokens):
+		"""
+		:param tokens: list of str
+		:return: dict: order -> {n-gram tuple: count}
+		"""
+		counts = {n: {} for n in self.orders}
+		window = ()
+		longest = self.orders[-1]
+		for token in tokens:
+			window = (window + (token,))[-longest:]
+			for n in self.orders:
+				if n > len(window):
+					break
+				gram = window[-n:]
+				order_counts = counts[n]
+				order_counts[gram] = order_counts.get(gram, 0) + 1
+		return counts
+
+	def features(self, tokens):
+		"""
+		:param tokens: list of str
+		:return: feature_vectors: a dictionary values for each ngram feature
+		"""
+		feature_vectors = {}
+		for n, order_counts in self.count(tokens).items():
+			total = len(tokens) - n + 1
+			prefix = self._prefixes[n]
+			for gram, count in order_counts.items():
+				gram_key = "_".join(gram)
+				if self.uppercase:
+					gram_key = gram_key.upper()
+				key = prefix + gram_key
+				if self.hashed:
+					key = zlib.crc32(key.encode("utf-8"))
+				feature_vectors[key] = count / total if self.relative else count
+		return feature_vectors
+
+
+_ngram_featurizer = NgramFeaturizer()
+_pos_featurizer = NgramFeaturizer(label="_POS", uppercase=True)
 
-	for sample in tri_dist.most_common():
-		sample_key = "TRIGRAM_" + "_".join(sample[0])
-		sample_value = sample[1] / num_tri
-		feature_vectors[sample_key] = sample_value
 
-	return feature_vectors
+def get_ngram_features(tokens):
+	"""
+	This function creates the unigram and bigram features as described in
+	the assignment3 handout.
+
+	:param tokens:
+	:return: feature_vectors: a dictionary values for each ngram feature
+	"""
+	tokens = get_normalizer().normalize_tokens(tokens)
+	return _ngram_featurizer.features(tokens)
 
 
 def get_pos_features(tags):
@@ -109,38 +275,8 @@ def get_pos_features(tags):
 	:param tags: list of POS tags
 	:return: feature_vectors: a dictionary values for each ngram-pos feature
 	"""
-	feature_vectors = {}
-	
-	tags = [normalize(tag) for tag in tags if normalize(tag) != None]
-
-	tag_unigrams = list(nltk.ngrams(tags, 1))
-	tag_bigrams = list(nltk.ngrams(tags, 2))
-	tag_trigrams = list(nltk.ngrams(tags, 3))
-	
-	num_uni = len(tag_unigrams)
-	num_bi = len(tag_bigrams)
-	num_tri = len(tag_trigrams)
-
-	uni_dist = nltk.FreqDist(tag_unigrams)
-	bi_dist = nltk.FreqDist(tag_bigrams)
-	tri_dist = nltk.FreqDist(tag_trigrams)
-
-	for sample in uni_dist.most_common():
-		sample_key = "UNI_POS_" + (sample[0][0]).upper()
-		sample_value = sample[1] / num_uni
-		feature_vectors[sample_key] = sample_value
-
-	for sample in bi_dist.most_common():
-		sample_key = "BIGRAM_POS_" + ("_".join(sample[0])).upper()
-		sample_value = sample[1] / num_bi
-		feature_vectors[sample_key] = sample_value
-
-	for sample in tri_dist.most_common():
-		sample_key = "TRIGRAM_POS_" + ("_".join(sample[0])).upper()
-		sample_value = sample[1] / num_tri
-		feature_vectors[sample_key] = sample_value
-
-	return feature_vectors
+	tags = get_normalizer().normalize_tokens(tags)
+	return _pos_featurizer.features(tags)
 
 
 def get_liwc_features(words):
@@ -153,9 +289,31 @@ def get_liwc_features(words):
 
 	# TODO: binning
 
-	feature_vectors = {}
 	text = " ".join(words)
 	liwc_scores = word_category_counter.score_text(text)
+	return liwc_feature_vectors(liwc_scores)
+
+
+def get_liwc_features_many(words_lists):
+	"""
+	get_liwc_features for a whole batch of tokenized texts, scored with
+	a single word_category_counter.score_many call.
+
+	:param words_lists: list of lists of words
+	:return: list of feature dictionaries, one per text
+	"""
+	matrix, category_names = word_category_counter.score_many([" ".join(words) for words in words_lists])
+	return [liwc_feature_vectors(Counter(dict(zip(category_names, row)))) for row in matrix.tolist()]
+
+
+def liwc_feature_vectors(liwc_scores):
+	"""
+	Builds the LIWC features from the scores of one text.
+
+	:param liwc_scores: Counter of category name -> score, as from score_text
+	:return: feature_vectors: a dictionary values for each LIWC feature
+	"""
+	feature_vectors = {}
 
 	# All possible keys to the scores start on line 269
 	# of the word_category_counter.py script
@@ -183,58 +341,143 @@ def get_liwc_features(words):
 
 FEATURE_SETS = {"word_pos_features", "word_features", "word_pos_liwc_features", "word_pos_opinion_features"}
 
+# The extractors each feature set is made of, in the order their features are added
+FEATURE_SET_EXTRACTORS = {
+	"word_features": ["ngram"],
+	"word_pos_features": ["ngram", "pos"],
+	"word_pos_liwc_features": ["ngram", "pos", "liwc"],
+	"word_pos_opinion_features": ["ngram", "pos", "liwc", "opinion"],
+}
 
-def get_opinion_features(tags):
-	"""
-	This function creates the opinion lexicon features
-	as described in the assignment3 handout.
+# Bump when an extractor changes, so cached features from older code are not reused
+FEATURES_VERSION = 2
 
-	the negative and positive data has been read into the following lists:
-	* neg_opinion
-	* pos_opinion
+
+# opinion word -> "NEG" or "POS", built on first use, see get_opinion_lexicon
+_opinion_lexicon = None
+
+
+def get_opinion_lexicon():
+	"""
+	Loads the opinion lexicon once into a dictionary from each word to its
+	polarity. Words listed as both negative and positive are left out, they
+	never produced a feature.
 
 	if you haven't downloaded the opinion lexicon, run the following commands:
 	*  import nltk
 	*  nltk.download('opinion_lexicon')
 
+	:return: dict: word -> "NEG" or "POS"
+	"""
+	global _opinion_lexicon
+	if _opinion_lexicon is None:
+		neg_opinion = set(nltk.corpus.opinion_lexicon.negative())
+		pos_opinion = set(nltk.corpus.opinion_lexicon.positive())
+		lexicon = {}
+		for token in neg_opinion - pos_opinion:
+			lexicon[token] = "NEG"
+		for token in pos_opinion - neg_opinion:
+			lexicon[token] = "POS"
+		_opinion_lexicon = lexicon
+	return _opinion_lexicon
+
+
+def get_opinion_features(tags):
+	"""
+	This function creates the opinion lexicon features
+	as described in the assignment3 handout.
+
+	Only the lexicon words found in the text get a feature (set to 1), along
+	with how many opinion words of each polarity the text has and the share
+	of them that is positive.
+
 	:param tags: tokens
 	:return: feature_vectors: a dictionary values for each opinion feature
 	"""
-	neg_opinion = nltk.corpus.opinion_lexicon.negative()
-	pos_opinion = nltk.corpus.opinion_lexicon.positive()
+	lexicon = get_opinion_lexicon()
 	feature_vectors = {}
+	counts = {"NEG": 0, "POS": 0}
 
-	# feature_vectors["OPINION_NEG"] = 0
-	# feature_vectors["OPINION_POS"] = 0
+	for token in get_normalizer().normalize_tokens(tags):
+		polarity = lexicon.get(token)
+		if polarity is not None:
+			feature_vectors["OPINION_" + polarity + "_" + token.upper()] = 1
+			counts[polarity] += 1
 
-	normalized_token = [normalize(tkn) for tkn in tags]
-
-	for token in neg_opinion:
-		if token in normalized_token and not token in pos_opinion:
-			opinion_key = "OPINION_NEG_" + token.upper()
-			feature_vectors[opinion_key] = 1
-		else:
-			opinion_key = "OPINION_NEG_" + token.upper()
-			feature_vectors[opinion_key] = 0
-		
-	for token in pos_opinion:
-		if token in normalized_token and not token in neg_opinion:
-			opinion_key = "OPINION_POS_" + token.upper()
-			feature_vectors[opinion_key] = 1
-		else:
-			opinion_key = "OPINION_POS_" + token.upper()
-			feature_vectors[opinion_key] = 0
+	feature_vectors["OPINION_NEG_COUNT"] = counts["NEG"]
+	feature_vectors["OPINION_POS_COUNT"] = counts["POS"]
+	if counts["NEG"] + counts["POS"] > 0:
+		feature_vectors["OPINION_POS_RATIO"] = counts["POS"] / (counts["NEG"] + counts["POS"])
 
 	return feature_vectors
 
 
-def get_features_category_tuples(category_text_dict, feature_set):
+def extract_features(texts, extractors):
+	"""
+	Runs extractors over a batch of texts.
+
+	:param texts: list of texts or AnnotatedText
+	:param extractors: for each text, the names of the extractors to run
+		(see FEATURE_SET_EXTRACTORS)
+	:return: for each text, a dictionary extractor name -> feature dictionary
+	"""
+	words_tags = [(text.words, text.tags) if isinstance(text, AnnotatedText) else get_words_tags(text) for text in texts]
+	extracted = [{} for text in texts]
+
+	# LIWC scores for the whole batch at once
+	liwc_texts = [i for i in range(len(texts)) if "liwc" in extractors[i]]
+	for i, liwc_features in zip(liwc_texts, get_liwc_features_many([words_tags[i][0] for i in liwc_texts])):
+		extracted[i]["liwc"] = liwc_features
+
+	for i, (words, tags) in enumerate(words_tags):
+		for extractor in extractors[i]:
+			if extractor == "ngram":
+				extracted[i][extractor] = get_ngram_features(words)
+			elif extractor == "pos":
+				extracted[i][extractor] = get_pos_features(tags)
+			elif extractor == "opinion":
+				extracted[i][extractor] = get_opinion_features(words)
+
+	return extracted
+
+
+def _init_worker(extractors):
+	"""
+	Loads the NLTK models the extractors use once per worker process, the
+	LIWC dictionary is loaded when this module is imported. Whatever fails
+	to load is left to fail in the extractors, where the error reaches the
+	caller; an exception here would only make the pool start new workers
+	forever.
+	"""
+	try:
+		annotate_text("Loading the tokenizer and tagger.")
+		get_normalizer()
+		if "opinion" in extractors:
+			get_opinion_lexicon()
+	except (LookupError, OSError):
+		pass
+
+
+def _extract_features_shard(shard):
+	texts, extractors = shard
+	return extract_features(texts, extractors)
+
+
+def get_features_category_tuples(category_text_dict, feature_set, cache=None, workers=1, annotations=None):
 	"""
 
 	You will might want to update the code here for the competition part.
 
-	:param category_text_dict:
+	:param category_text_dict: category -> list of texts, or of AnnotatedText
+		(see annotate_corpus) to reuse their words and tags
 	:param feature_set:
+	:param cache: optional feature_cache.FeatureCache, features found there
+		are not extracted again and new ones are added to it
+	:param workers: number of processes to extract features with, the
+		texts are split in contiguous shards so the order does not change
+	:param annotations: optional dict text -> AnnotatedText shared between
+		calls for several feature sets: the texts with features to extract
+		are annotated only if they are not in it yet, and added to it
 	:return:
 	"""
 	features_category_tuples = []
@@ -242,29 +485,69 @@ def get_features_category_tuples(category_text_dict, feature_set):
 
 	assert feature_set in FEATURE_SETS, "unrecognized feature set:{}, Accepted values:{}".format(feature_set, FEATURE_SETS)
 
+	categories = []
+	inputs = []
 	for category in category_text_dict:
 		for text in category_text_dict[category]:
-
-			words, tags = get_words_tags(text)
-			feature_vectors = {}
-
-			if feature_set == "word_features":
-				feature_vectors.update(get_ngram_features(words))
-			elif feature_set == "word_pos_features":
-				feature_vectors.update(get_ngram_features(words))
-				feature_vectors.update(get_pos_features(tags))
-			elif feature_set == "word_pos_liwc_features":
-				feature_vectors.update(get_ngram_features(words))
-				feature_vectors.update(get_pos_features(tags))
-				feature_vectors.update(get_liwc_features(words))
-			elif feature_set == "word_pos_opinion_features":
-				feature_vectors.update(get_ngram_features(words))
-				feature_vectors.update(get_pos_features(tags))
-				feature_vectors.update(get_liwc_features(words))
-				feature_vectors.update(get_opinion_features(words))
-
-			features_category_tuples.append((feature_vectors, category))
-			all_texts.append(text)
+			inputs.append(text)
+			categories.append(category)
+			all_texts.append(text.text if isinstance(text, AnnotatedText) else text)
+
+	feature_set_extractors = FEATURE_SET_EXTRACTORS[feature_set]
+	extracted = [{} for text in all_texts]
+	if cache is not None:
+		for text, text_extracted in zip(all_texts, extracted):
+			for extractor in feature_set_extractors:
+				features = cache.get(text, extractor)
+				if features is not None:
+					text_extracted[extractor] = features
+
+	# only the texts with features missing from the cache are worked on
+	missing = [i for i in range(len(all_texts)) if len(extracted[i]) < len(feature_set_extractors)]
+	missing_extractors = [[extractor for extractor in feature_set_extractors if extractor not in extracted[i]] for i in missing]
+
+	pool = None
+	if workers > 1 and len(missing) > 1:
+		pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(feature_set_extractors,))
+	try:
+		if annotations is not None:
+			# texts are annotated when an extractor first needs them, once for all the feature sets
+			unannotated = list(dict.fromkeys(all_texts[i] for i in missing if not isinstance(inputs[i], AnnotatedText) and all_texts[i] not in annotations))
+			if pool is not None and len(unannotated) > 1:
+				new_annotations = pool.map(annotate_text, unannotated, chunksize=-(-len(unannotated) // (workers * 4)))
+			else:
+				new_annotations = [annotate_text(text) for text in unannotated]
+			annotations.update(zip(unannotated, new_annotations))
+			for i in missing:
+				if not isinstance(inputs[i], AnnotatedText):
+					inputs[i] = annotations[all_texts[i]]
+
+		if pool is not None:
+			shard_size = -(-len(missing) // (workers * 4))
+			shards = [([inputs[i] for i in missing[start:start + shard_size]], missing_extractors[start:start + shard_size])
+					  for start in range(0, len(missing), shard_size)]
+			new_extracted = [text_extracted for shard in pool.map(_extract_features_shard, shards) for text_extracted in shard]
+		else:
+			new_extracted = extract_features([inputs[i] for i in missing], missing_extractors)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	for i, text_extracted in zip(missing, new_extracted):
+		extracted[i].update(text_extracted)
+		if cache is not None:
+			for extractor, features in text_extracted.items():
+				cache.put(all_texts[i], extractor, features)
+
+	if cache is not None:
+		cache.commit()
+
+	for text_extracted, category in zip(extracted, categories):
+		feature_vectors = {}
+		for extractor in feature_set_extractors:
+			feature_vectors.update(text_extracted[extractor])
+		features_category_tuples.append((feature_vectors, category))
 
 	return features_category_tuples, all_texts
 
@@ -288,11 +571,11 @@ def features_stub():
 	datasets = ["training", "development", "testing"]
 	
 	for dataset in datasets:
+		datafile = "data/imdb-" + dataset + ".data"
+		raw_data = data_helper.read_file(datafile)
+		positive_texts, negative_texts = data_helper.get_reviews(raw_data)
+		category_texts = annotate_corpus({"positive": positive_texts, "negative": negative_texts})
 		for feature_set in feature_sets:
-			datafile = "data/imdb-" + dataset + ".data"
-			raw_data = data_helper.read_file(datafile)
-			positive_texts, negative_texts = data_helper.get_reviews(raw_data)
-			category_texts = {"positive": positive_texts, "negative": negative_texts}
 			features_category_tuples, texts = get_features_category_tuples(category_texts, feature_set)
 			filename = "best_features/" + feature_set + "-" + dataset + "-features.txt"
 			write_features_category(features_category_tuples, filename)
@@ -2,10 +2,16 @@
 import re, nltk, pickle, argparse, pprint
 import os
 import data_helper
-from features import get_features_category_tuples
+from features import get_features_category_tuples, FEATURES_VERSION
+from feature_cache import FeatureCache
+from feature_store import write_feature_set, read_feature_set, feature_category_tuples
 
 DATA_DIR = "data"
 
+# text -> AnnotatedText, shared by all the feature sets so each text is
+# tokenized and tagged at most once
+annotations = {}
+
 def write_features_category(features_category_tuples, output_file_name):
     output_file = open("{}-features.txt".format(output_file_name), "w", encoding="utf-8")
     for (features, category) in features_category_tuples:
@@ -45,25 +51,53 @@ def evaluate(classifier, features_category_tuples, reference_text, data_set_name
     return accuracy, probability, confusion_matrix
 
 
-def build_features(data_file, feat_name, save_feats=None, binning=False):
+def saved_features_fname(feats_dir, data_file, feat_name):
+    return os.path.join(feats_dir, "{}-{}.features.bin".format(feat_name, os.path.splitext(data_file)[0]))
+
+
+def load_saved_features(feats_dir, data_file, feat_name):
+    """
+    :return: the features saved in feats_dir by an earlier run, or None when
+        there are none or they are older than the data or the extractors
+    """
+    fname = saved_features_fname(feats_dir, data_file, feat_name)
+    if not os.path.exists(fname) or os.path.getmtime(fname) < os.path.getmtime(os.path.join(DATA_DIR, data_file)):
+        return None
+    feature_set = read_feature_set(fname)
+    if feature_set.version != FEATURES_VERSION:
+        return None
+    return feature_set
+
+
+def build_features(data_file, feat_name, save_feats=None, binning=False, cache=None, workers=1, feats_dir=None):
     # read text data
     raw_data = open(os.path.join(DATA_DIR, data_file), "r").read()
     positive_texts, negative_texts = data_helper.get_reviews(raw_data)
 
     category_texts = {"positive": positive_texts, "negative": negative_texts}
 
-    # build features
-    features_category_tuples, texts = get_features_category_tuples(category_texts, feat_name)
+    # reuse the features saved by an earlier run
+    if feats_dir is not None:
+        feature_set = load_saved_features(feats_dir, data_file, feat_name)
+        if feature_set is not None:
+            return feature_category_tuples(feature_set), positive_texts + negative_texts
+
+    # build features, annotating only the texts with features missing from the cache
+    features_category_tuples, texts = get_features_category_tuples(category_texts, feat_name, cache=cache, workers=workers,
+                                                                   annotations=annotations)
 
     # save features to file
     if save_feats is not None:
         write_features_category(features_category_tuples, save_feats)
+    if feats_dir is not None:
+        os.makedirs(feats_dir, exist_ok=True)
+        write_feature_set(saved_features_fname(feats_dir, data_file, feat_name), features_category_tuples, version=FEATURES_VERSION)
 
     return features_category_tuples, texts
 
 
-def train_model(datafile, feature_set, save_model=None):
-    features_data, texts = build_features(datafile, feature_set)
+def train_model(datafile, feature_set, save_model=None, cache=None, workers=1, feats_dir=None):
+    features_data, texts = build_features(datafile, feature_set, cache=cache, workers=workers, feats_dir=feats_dir)
 
     classifier = nltk.classify.NaiveBayesClassifier.train(features_data)
 
@@ -72,11 +106,11 @@ def train_model(datafile, feature_set, save_model=None):
     return classifier
 
 
-def train_eval(train_file, feature_set, classifier_fname, eval_file=None):
+def train_eval(train_file, feature_set, classifier_fname, eval_file=None, cache=None, workers=1, feats_dir=None):
 
     # train the model
     split_name = "train"
-    model = train_model(train_file, feature_set, classifier_fname)
+    model = train_model(train_file, feature_set, classifier_fname, cache=cache, workers=workers, feats_dir=feats_dir)
     model.show_most_informative_features(20)
 
     # save the model
@@ -85,7 +119,7 @@ def train_eval(train_file, feature_set, classifier_fname, eval_file=None):
 
     # evaluate the model
     if eval_file is not None:
-        features_data, texts = build_features(eval_file, feature_set, binning=None)
+        features_data, texts = build_features(eval_file, feature_set, binning=None, cache=cache, workers=workers, feats_dir=feats_dir)
         accuracy, probability, cm = evaluate(model, features_data, texts, data_set_name=None)
         print("The accuracy of {} is: {}".format(eval_file, accuracy))
         print("Proabability per class:")
@@ -102,14 +136,22 @@ def main():
     # add the necessary arguments to the argument parser
     parser = argparse.ArgumentParser(description='Assignment 3')
     parser.add_argument('-d', dest="data_fname", default="imdb-training.data", help='File name of the testing data.')
+    parser.add_argument('-cache', dest="cache_fname", default=None, help='File to cache extracted features in between runs.')
+    parser.add_argument('-workers', dest="workers", type=int, default=1, help='Number of processes to extract features with.')
+    parser.add_argument('-feats', dest="feats_dir", default=None, help='Directory to save extracted feature sets in and load them from in later runs.')
     args = parser.parse_args()
 
     train_data = args.data_fname
     eval_data = "imdb-testing.data"
+    cache = FeatureCache(args.cache_fname, FEATURES_VERSION) if args.cache_fname is not None else None
 
     for feat_set in ["word_features", "word_pos_features", "word_pos_liwc_features", "word_pos_opinion_features"]:
         print("\nTraining with {}".format(feat_set))
-        acc = train_eval(train_data, feat_set, ("imdb-" + feat_set + "-model-P1.pickle"), eval_file=eval_data)
+        acc = train_eval(train_data, feat_set, ("imdb-" + feat_set + "-model-P1.pickle"), eval_file=eval_data, cache=cache, workers=args.workers,
+                         feats_dir=args.feats_dir)
+
+    if cache is not None:
+        cache.close()
 
 
 if __name__ == "__main__":
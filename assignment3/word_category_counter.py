@@ -14,7 +14,13 @@ from __future__ import division
 import re
 import string
 import os, sys
-from collections import Counter, defaultdict
+import bisect, csv, glob, json, mmap, multiprocessing, struct, zipfile
+from array import array
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+try:
+    import numpy
+except ImportError: #counting falls back to plain lists
+    numpy = None
 
 #This actually captures most of what LIWC does...., I have no idea why it sells...
 _liwc_tokenizer = re.compile(r'(\d[\d\.\,\-\:]*\d\.?|[a-zA-Z][a-zA-Z\.\']*[a-zA-Z]|\S|\n)',re.UNICODE|re.IGNORECASE) 
@@ -28,44 +34,171 @@ def score_text(text, raw_counts=True, scores=None, unique_words=None):
     if scores == None: scores = Counter()
     if unique_words == None: unique_words = set()
     
+    category_ids, sentences = _text_category_ids(text, unique_words)
+    return _finish_scores(_dictionary.count_category_ids(category_ids), sentences, unique_words, raw_counts, scores)
+
+def _finish_scores(counts, sentences, unique_words, raw_counts, scores):
+    """Adds up the per-text totals the way score_text() reports them"""
+    if sentences:
+        scores['Sentences']+=sentences
+    
+    _dictionary.category_scores(counts, scores)
+    
+    scores['Unique Words']=len(unique_words)
+    if scores['Sentences'] > 0:
+    	scores['Words Per Sentence']=scores['Word Count']/scores['Sentences']
+    else:
+    	scores['Words Per Sentence'] = 1;
+    
+    if not raw_counts:
+        scores = normalize_scores(scores)
+    
+    return scores
+
+def _text_category_ids(text, unique_words):
+    """Tokenizes text, returns the category ids of all its tokens (see Dictionary.score_word_ids) 
+        and the number of sentences, words are added to unique_words
+    """
     all_tokens = _liwc_tokenizer.findall(text.lower())
-    sentence_terminated = True
+    category_ids = [] #every token adds the ids of its categories, they get counted all at once
+    sentences, sentence_terminated = _score_tokens(all_tokens, '', '', category_ids, unique_words, True)
+    if not sentence_terminated:
+        sentences+=1
+    
+    return category_ids, sentences
+
+def _score_tokens(all_tokens, first_previous_token, last_next_token, category_ids, unique_words, sentence_terminated):
+    """Scores a run of tokens into category_ids, the first and last token's outside neighbours are passed in
+        Returns the number of sentences ended in the run and whether the run ends terminated
+    """
+    sentences = 0
     for i in range(len(all_tokens)):
         token = all_tokens[i]
         if len(token)==0: continue
         
         if token[0].isdigit(): #Numbers
-            scores.update(_dictionary.score_word(token))
+            category_ids.extend(_dictionary.score_word_ids(token))
             sentence_terminated=False
         elif token[0].isalpha(): #Words
             unique_words.add(token)
-            previous_token = all_tokens[i-1] if i>0 else ''
-            next_token = all_tokens[i+1] if i<len(all_tokens)-1 else ''
-            scores.update(_dictionary.score_word(token, previous_token, next_token))
+            previous_token = all_tokens[i-1] if i>0 else first_previous_token
+            next_token = all_tokens[i+1] if i<len(all_tokens)-1 else last_next_token
+            category_ids.extend(_dictionary.score_word_ids(token, previous_token, next_token))
             sentence_terminated=False
         else: #Punctuation and stuff
-            scores.update(_dictionary.score_word(token))
+            category_ids.extend(_dictionary.score_word_ids(token))
 
         if token in Dictionary.sentence_punctuation and not sentence_terminated:
-            scores['Sentences']+=1
+            sentences+=1
             sentence_terminated = True
+    
+    return sentences, sentence_terminated
 
-    if not sentence_terminated:
-        scores['Sentences']+=1
+class StreamingScorer(object):
+    """Scores text fed in pieces of any size, the totals match score_text() on the whole text.
+        Only the end of the last piece (a partial token) and the last token (still waiting for its 
+        next neighbour) are held back, so memory doesn't grow with the input, apart from unique_words.
+        
+        scorer = StreamingScorer()
+        scorer.feed_file(open('huge.log'))
+        scores = scorer.close()
+    """
+    def __init__(self, unique_words=None):
+        if unique_words == None: unique_words = set()
+        self.unique_words = unique_words
+        self._counts = None
+        self._sentences = 0
+        self._sentence_terminated = True
+        self._tail = '' #text after the last whitespace, it may continue in the next piece
+        self._previous_token = ''
+        self._pending_token = None #scored once the token after it is known
+        self._closed = False
     
-    scores['Unique Words']=len(unique_words)
-    if scores['Sentences'] > 0:
-    	scores['Words Per Sentence']=scores['Word Count']/scores['Sentences']
-    else:
-    	scores['Words Per Sentence'] = 1;
+    def feed(self, text):
+        if self._closed:
+            raise ValueError("feed() after close()")
+        text = self._tail + text.lower()
+        #tokens never contain whitespace (other than a lone newline), so the text up to the last whitespace tokenizes 
+        #exactly as it would inside the whole text
+        cut = len(text)
+        while cut > 0 and not text[cut-1].isspace():
+            cut -= 1
+        self._tail = text[cut:]
+        self._score(_liwc_tokenizer.findall(text[:cut]), final=False)
+        return self
     
-    if not raw_counts:
-        scores = normalize_scores(scores)
+    def feed_file(self, fin, chunk_size=1<<20):
+        for chunk in iter(lambda: fin.read(chunk_size), ''):
+            self.feed(chunk)
+        return self
     
-    return scores
+    def _score(self, tokens, final):
+        if self._pending_token is not None:
+            tokens = [self._pending_token] + tokens
+        if not final:
+            if not tokens:
+                return
+            self._pending_token = tokens.pop()
+            next_token = self._pending_token
+        else:
+            self._pending_token = None
+            next_token = ''
+        
+        category_ids = []
+        sentences, self._sentence_terminated = _score_tokens(tokens, self._previous_token, next_token, category_ids,
+                                                             self.unique_words, self._sentence_terminated)
+        self._sentences += sentences
+        self._counts = _dictionary.count_category_ids(category_ids, self._counts)
+        if tokens:
+            self._previous_token = tokens[-1]
+    
+    def close(self, raw_counts=True, scores=None):
+        """Scores what is left and returns the totals, see score_text() for the parameters"""
+        if scores == None: scores = Counter()
+        if not self._closed:
+            self._score(_liwc_tokenizer.findall(self._tail), final=True)
+            self._tail = ''
+            if not self._sentence_terminated:
+                self._sentences+=1
+            self._closed = True
+        return _finish_scores(self._counts, self._sentences, self.unique_words, raw_counts, scores)
+
+def score_many(texts, raw_counts=True, bound_scores=True):
+    """Scores a batch of texts at once, needs numpy
+        Returns (matrix, category_names), a dense float array with a row per text and a column per category,
+        row i holds what score_text(texts[i], raw_counts) would, categories it leaves out are 0
+    """
+    if numpy is None:
+        raise ImportError("score_many() needs numpy")
+    
+    category_names = _dictionary.category_names() + ['Sentences', 'Unique Words', 'Words Per Sentence']
+    n_categories = len(category_names)
+    word_count, sentences, unique, per_sentence = [category_names.index(category) for category in 
+                                                    ('Word Count', 'Sentences', 'Unique Words', 'Words Per Sentence')]
+    
+    cells = [] #row*n_categories+column for every category id of every text, counted in one go
+    totals = numpy.zeros((len(texts), 2))
+    for row, text in enumerate(texts):
+        unique_words = set()
+        category_ids, totals[row, 0] = _text_category_ids(text, unique_words)
+        totals[row, 1] = len(unique_words)
+        cells.extend(row*n_categories+i for i in category_ids)
+    
+    matrix = numpy.bincount(numpy.asarray(cells, dtype=numpy.intp), minlength=len(texts)*n_categories)
+    matrix = matrix.reshape((len(texts), n_categories)).astype(float)
+    matrix[:, sentences] = totals[:, 0]
+    matrix[:, unique] = totals[:, 1]
+    matrix[:, per_sentence] = 1
+    has_sentences = matrix[:, sentences] > 0
+    matrix[has_sentences, per_sentence] = matrix[has_sentences, word_count]/matrix[has_sentences, sentences]
+    
+    if not raw_counts:
+        matrix = normalize_matrix(matrix, category_names, bound_scores)
+    return matrix, category_names
 
 def score_file(filename, raw_counts=False, scores=None, unique_words=None):
-    return score_text(open(filename).read(), raw_counts=raw_counts, scores=scores, unique_words=unique_words)
+    with open(filename) as fin:
+        return StreamingScorer(unique_words).feed_file(fin).close(raw_counts=raw_counts, scores=scores)
 
 def normalize_scores(scores, bound_scores=True):
     """@summary: Converts counts to percentages"""
@@ -83,20 +216,108 @@ def normalize_scores(scores, bound_scores=True):
         new_scores[category]=score
     return new_scores
 
+def normalize_matrix(matrix, category_names, bound_scores=True):
+    """normalize_scores() for every row of a score_many() matrix"""
+    word_count = matrix[:, category_names.index('Word Count')][:, numpy.newaxis]
+    percentages = numpy.where(word_count > 0, 100.0*matrix/numpy.where(word_count > 0, word_count, 1), 
+                              numpy.where(matrix > 0, 100.0, 0.0))
+    if bound_scores: #Since certain categories can exceed word count
+        percentages = numpy.clip(percentages, 0.0, 100.0)
+    for category in ('Word Count', 'Sentences', 'Words Per Sentence', 'Newlines'):
+        if category in category_names:
+            percentages[:, category_names.index(category)] = matrix[:, category_names.index(category)]
+    return percentages
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'size', 'maxsize', 'policy'])
+
+class ResolutionCache(object):
+    """A bounded token->resolution cache for Dictionary, 
+        evicts the least recently used ('lru') or least frequently used ('lfu', ties go to the oldest) entry
+    """
+    DEFAULT_SIZE = 100000
+    
+    def __init__(self, maxsize=DEFAULT_SIZE, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("cache policy should be 'lru' or 'lfu', not "+repr(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+    
+    def clear(self):
+        self._entries = OrderedDict() #lru: key->value, oldest first
+        self._frequencies = dict() #lfu: key->use count
+        self._buckets = defaultdict(OrderedDict) #lfu: use count->keys, oldest first
+        self._min_frequency = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        """Returns the cached value or None"""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+        else:
+            self._touch(key)
+        return self._entries[key]
+    
+    def put(self, key, value):
+        if self.maxsize is not None and self.maxsize <= 0:
+            return
+        if key in self._entries:
+            self._entries[key] = value
+            return
+        if self.maxsize is not None and len(self._entries) >= self.maxsize:
+            self._evict()
+        self._entries[key] = value
+        if self.policy == 'lfu':
+            self._frequencies[key] = 1
+            self._buckets[1][key] = None
+            self._min_frequency = 1
+    
+    def _touch(self, key):
+        frequency = self._frequencies[key]
+        del self._buckets[frequency][key]
+        if not self._buckets[frequency]:
+            del self._buckets[frequency]
+            if self._min_frequency == frequency:
+                self._min_frequency = frequency+1
+        self._frequencies[key] = frequency+1
+        self._buckets[frequency+1][key] = None
+    
+    def _evict(self):
+        if self.policy == 'lru':
+            self._entries.popitem(last=False)
+            return
+        bucket = self._buckets[self._min_frequency]
+        key, junk = bucket.popitem(last=False)
+        if not bucket:
+            del self._buckets[self._min_frequency]
+        del self._frequencies[key]
+        del self._entries[key]
+    
+    def info(self):
+        return CacheInfo(self.hits, self.misses, len(self._entries), self.maxsize, self.policy)
+
 class Dictionary():
     sentence_punctuation = {'.','?','!','\n'}
     _TYPE_BASIC = 'basic'
     _TYPE_PRE = 'pre'
     _TYPE_POST = 'post'
     
-    def __init__(self, filename, use_long_category_names=True, internal_category_list=None):
-        """@param internal_category_list: Should be None or '2001' or '2007' """
-        self._stems = dict()#this is a prefix tree for the stems, the leaves are sets of categories
-        self._lookup = defaultdict(dict) #word->type->????->{categories} 
-                                                    #type can be one of "basic", "pre", "post". 
-                                                    #basic leads to a set of categories, 
-                                                    #pre and post lead to a list of tuples of (conditions, if_true categories, if_false categories)
-        self._ignored=set() #caches words that are searched for but not found, this favors processing over memory
+    def __init__(self, filename, use_long_category_names=True, internal_category_list=None, 
+                 cache_size=ResolutionCache.DEFAULT_SIZE, cache_policy='lru'):
+        """@param internal_category_list: Should be None or '2001' or '2007' 
+            @param cache_size: How many resolved tokens to keep, None for no limit
+            @param cache_policy: 'lru' or 'lfu', which tokens get evicted when the cache is full
+        """
+        self._lexicon = None #a _Lexicon (parsed) or _MappedLexicon (compiled), see below
+        self._resolved = ResolutionCache(cache_size, cache_policy) #token->(category ids, rules)
         
         self._setup_category_lookup(internal_category_list, use_long_category_names)
         try:
@@ -109,10 +330,29 @@ class Dictionary():
                                    "Hope this helps...\n"])
             raise
     
+    @classmethod
+    def load_compiled(cls, filename, cache_size=ResolutionCache.DEFAULT_SIZE, cache_policy='lru'):
+        """Loads a dictionary written by save_compiled(), the tables stay memory-mapped (read only),
+            so every process that loads the same file shares the same pages
+        """
+        dictionary = cls.__new__(cls)
+        dictionary._lexicon = _MappedLexicon(filename)
+        dictionary._resolved = ResolutionCache(cache_size, cache_policy)
+        dictionary._setup_scoring()
+        return dictionary
+    
+    def save_compiled(self, filename):
+        """Writes the dictionary in the binary format read by load_compiled()"""
+        self._lexicon.save(filename)
     
     _dictionary_line_re =  re.compile(r'^(\w+)(\*?)\s*(.*)$')
     _dictionary_line_categories_re = re.compile(r'(\d+|\<(\w+(\s+\w+)*)\>(\d+)(\/(\d+))?|\(\s*(\d+(\s+\d+)*)\s*\)(\d+)(\/(\d+))?)')
     def load_dictionary_file(self, filename, internal_category_list=None):
+        stems = dict()#this is a prefix tree for the stems, the leaves are sets of categories
+        lookup = defaultdict(dict) #word->type->????->{categories} 
+                                   #type can be one of "basic", "pre", "post". 
+                                   #basic leads to a set of categories, 
+                                   #pre and post lead to a list of tuples of (conditions, if_true categories, if_false categories)
         category_mode = False
         for line in open(filename):
             line = line.strip()
@@ -137,11 +377,11 @@ class Dictionary():
                     continue
                 elif category.isdigit():
                     if is_stem=='*':
-                        self._add_stemmed(word, self._category_lookup[int(category)])
+                        self._add_stemmed(stems, word, self._category_lookup[int(category)])
                     else:
-                        if Dictionary._TYPE_BASIC not in self._lookup[word]:
-                            self._lookup[word][Dictionary._TYPE_BASIC]=set()
-                        self._lookup[word][Dictionary._TYPE_BASIC].add(self._category_lookup[int(category)])
+                        if Dictionary._TYPE_BASIC not in lookup[word]:
+                            lookup[word][Dictionary._TYPE_BASIC]=set()
+                        lookup[word][Dictionary._TYPE_BASIC].add(self._category_lookup[int(category)])
                 
                 elif '(' in category or '<' in category: #convoluted special cases lead to much of the complexity in this program
                     junk, post, junk, if_post, junk, if_not_post, pre, junk, if_pre, junk, if_not_pre = category_group
@@ -158,24 +398,27 @@ class Dictionary():
                         if if_not_post != '':
                             if_not_true = self._category_lookup[int(if_not_post)]
                         
-                    if entry_type not in self._lookup[word]:
-                            self._lookup[word][entry_type]=list()
+                    if entry_type not in lookup[word]:
+                            lookup[word][entry_type]=list()
                     
-                    for other_conditions, other_if_set, other_if_not_set in self._lookup[word][entry_type]:
+                    for other_conditions, other_if_set, other_if_not_set in lookup[word][entry_type]:
                         if str(other_conditions)==str(conditions): #a little costly on load means less on use
                             other_if_set.add(if_true)
                             other_if_not_set.add(if_not_true)
                             break
                     else: #for else means the for ended naturally
-                        self._lookup[word][entry_type].append( (conditions, {if_true}, {if_not_true}) )
+                        lookup[word][entry_type].append( (conditions, {if_true}, {if_not_true}) )
+        
+        self._lexicon = _Lexicon(sorted(set(self._category_lookup.values())), lookup, stems)
+        self._setup_scoring()
     
     def _translate_category_name(self, category_name):
         if category_name.lower() in self._category_name_lookup:
             return self._category_name_lookup[category_name.lower()]
         return category_name
     
-    def _add_stemmed(self, word, category):
-        current_node = self._stems
+    def _add_stemmed(self, stems, word, category):
+        current_node = stems
         for char in word[:-1]:
             if char not in current_node:
                 current_node[char]=dict()
@@ -190,65 +433,153 @@ class Dictionary():
     _punctuation_of_interest = {'?':'Question Marks', '!':'Exclamation Marks', '"':'Quote Marks',
                                 ',':'Comma',':':'Colon',';':'Semicolon','-':'Dash','\'':'Apostrophe',
                                 '(':'Parenthesis', ')':'Parenthesis', '{':'Parenthesis', '}':'Parenthesis', '[':'Parenthesis', ']':'Parenthesis' }
-    def score_word(self, word, previous_word=None, next_word=None):
-        scores = Counter()
-        if word is None:
-            return scores
+    _other_categories = ['Newlines', 'Word Count', 'Numerals', 'Six Letter Words', 'Dictionary Words', 
+                         'All Punctuation', 'Other Punctuation'] + sorted(set(_punctuation_of_interest.values()))
+    def _setup_scoring(self):
+        """Every category a word can score gets an id, the dictionary's own categories keep their bit numbers"""
+        self._score_names = list(self._lexicon.categories)
+        self._score_ids = dict((category, i) for i, category in enumerate(self._score_names))
+        for category in Dictionary._other_categories:
+            if category not in self._score_ids:
+                self._score_ids[category] = len(self._score_names)
+                self._score_names.append(category)
         
+        #pre/post entries become mask tests: (type, condition categories mask or next words, 
+        #                                     if_true ids, if_false ids, if_true mask, if_false mask)
+        self._rules = dict()
+        for word, word_rules in self._lexicon.rules().items():
+            self._rules[word] = tuple((entry_type, 
+                                       self._ids_mask(self._score_ids[category] for category in conditions) 
+                                           if entry_type==Dictionary._TYPE_PRE else frozenset(conditions),
+                                       tuple(self._score_ids[category] for category in if_set),
+                                       tuple(self._score_ids[category] for category in if_not_set),
+                                       self._ids_mask(self._score_ids[category] for category in if_set),
+                                       self._ids_mask(self._score_ids[category] for category in if_not_set))
+                                      for entry_type, conditions, if_set, if_not_set in word_rules)
+        self._resolved.clear()
+    
+    @staticmethod
+    def _ids_mask(ids):
+        mask = 0
+        for i in ids:
+            mask |= 1 << i
+        return mask
+    
+    def warm_cache(self, vocabulary):
+        """Resolves every word of vocabulary ahead of time, either an iterable of words or the name of a file
+            with a word at the start of each line (so word frequency lists work as they are)
+        """
+        if isinstance(vocabulary, str):
+            with open(vocabulary) as fin:
+                vocabulary = [line.split()[0] for line in fin if line.strip()]
+        for word in vocabulary:
+            self._resolve(word.lower())
+    
+    def cache_info(self):
+        return self._resolved.info()
+    
+    def _resolve(self, word):
+        """Returns (category ids, rules, mask of the ids) for a token, 
+            the ids don't depend on the neighbouring words, the rules (pre/post entries) do
+        """
+        resolved = self._resolved.get(word)
+        if resolved is not None:
+            return resolved
+        
+        ids = []
+        rules = ()
         if '\n' in word:
-            scores['Newlines']+=1
-            
-        word = word.strip().lower()
+            ids.append(self._score_ids['Newlines'])
         
-        if len(word)==0:
+        stripped = word.strip().lower()
+        if len(stripped)==0:
             pass
-        elif word[0].isdigit():
-            scores['Word Count']+=1
-            scores['Numerals']+=1
-        elif Dictionary._pure_punctuation_re.match(word):
-            scores['All Punctuation']+=1
-            for char in word:
-                if char in Dictionary._punctuation_of_interest:
-                    scores[Dictionary._punctuation_of_interest[char]]+=1
-                else:
-                    scores['Other Punctuation']+=1
+        elif stripped[0].isdigit():
+            ids.append(self._score_ids['Word Count'])
+            ids.append(self._score_ids['Numerals'])
+        elif Dictionary._pure_punctuation_re.match(stripped):
+            ids.append(self._score_ids['All Punctuation'])
+            for char in stripped:
+                ids.append(self._score_ids[Dictionary._punctuation_of_interest.get(char, 'Other Punctuation')])
         else:
-            scores['Word Count']+=1
-            if len(word) > 6:
-                scores['Six Letter Words'] += 1
-            if word not in self._ignored:
-                if word in self._lookup:
-                    for entry_type in self._lookup[word]:
-                        if entry_type==Dictionary._TYPE_BASIC:
-                            scores.update(self._lookup[word][entry_type])
-                        else:
-                            for conditions, if_set, if_not_set in self._lookup[word][entry_type]:
-                                if ((entry_type==Dictionary._TYPE_PRE and not set(self.score_word(word=previous_word, next_word=word).keys()).isdisjoint(set(conditions))) or 
-                                    (entry_type==Dictionary._TYPE_POST and next_word is not None and next_word.lower() in conditions)):
-                                    scores.update(if_set)
-                                else:
-                                    scores.update(if_not_set)
-                else:
-                    current_node = self._stems
-                    for char in word:
-                        if char in current_node:
-                            current_node = current_node[char]
-                            if isinstance(current_node, set):
-                                if Dictionary._TYPE_BASIC not in self._lookup[word]:
-                                    self._lookup[word][Dictionary._TYPE_BASIC]=set()
-                                self._lookup[word][Dictionary._TYPE_BASIC].update(current_node) #add to main lookup for time efficiency
-                                scores.update(self._lookup[word][Dictionary._TYPE_BASIC])
-                                break
-                        else:
-                            self._ignored.add(word) #dead end
-                            break
-                    else:
-                        self._ignored.add(word) #not found but didn't hit a dead end
-
-                if word not in self._ignored: #Note this is "still not in"
-                    scores['Dictionary Words']+=1
+            ids.append(self._score_ids['Word Count'])
+            if len(stripped) > 6:
+                ids.append(self._score_ids['Six Letter Words'])
+            entry = self._lexicon.find(stripped)
+            if entry is not None:
+                mask, word_rules = entry
+                ids.extend(self._lexicon.category_ids(mask))
+                rules = self._rules.get(stripped, ())
+                ids.append(self._score_ids['Dictionary Words'])
+        
+        resolved = (tuple(ids), rules, Dictionary._ids_mask(ids))
+        self._resolved.put(word, resolved)
+        return resolved
+    
+    def score_word_ids(self, word, previous_word=None, next_word=None):
+        """score_word() as a sequence of category ids, an id repeats when its category counts more than once"""
+        if word is None:
+            return ()
+        ids, rules, mask = self._resolve(word)
+        if not rules:
+            return ids
+        
+        ids = list(ids)
+        word = word.strip().lower()
+        previous_mask = None
+        for entry_type, conditions, if_ids, if_not_ids, if_mask, if_not_mask in rules:
+            if entry_type==Dictionary._TYPE_PRE:
+                if previous_mask is None:
+                    previous_mask = self._previous_word_mask(previous_word, word)
+                condition = previous_mask & conditions
+            else:
+                condition = next_word is not None and next_word.lower() in conditions
+            ids.extend(if_ids if condition else if_not_ids)
+        return ids
+    
+    def _previous_word_mask(self, previous_word, word):
+        """The categories of previous_word as scored on its own with word after it (its pre entries can't match)"""
+        if previous_word is None:
+            return 0
+        ids, rules, mask = self._resolve(previous_word)
+        for entry_type, conditions, if_ids, if_not_ids, if_mask, if_not_mask in rules:
+            if entry_type==Dictionary._TYPE_POST and word in conditions:
+                mask |= if_mask
+            else:
+                mask |= if_not_mask
+        return mask
+    
+    def score_word(self, word, previous_word=None, next_word=None):
+        return Counter(self._score_names[i] for i in self.score_word_ids(word, previous_word, next_word))
+    
+    def count_category_ids(self, ids, counts=None):
+        """Counts category ids into a fixed-length array, slot i holds the count of category_names()[i]
+            @param counts: A previous result to add to (in place) for running totals
+        """
+        if numpy is not None:
+            new_counts = numpy.bincount(numpy.asarray(ids, dtype=numpy.intp), minlength=len(self._score_names))
+            if counts is None:
+                return new_counts
+            counts += new_counts
+            return counts
+        if counts is None:
+            counts = [0]*len(self._score_names)
+        for i in ids:
+            counts[i] += 1
+        return counts
+    
+    def category_scores(self, counts, scores=None):
+        """The named view of count_category_ids(), adds the non-zero counts to scores (a Counter)"""
+        if scores is None: scores = Counter()
+        for i, count in enumerate(counts):
+            if count:
+                scores[self._score_names[i]] += int(count)
         return scores
     
+    def category_names(self):
+        """Names of the category ids, in id order"""
+        return list(self._score_names)
+    
     def _setup_category_lookup(self, internal_category_list, use_long_category_names):
         self._category_name_lookup = dict()
         if use_long_category_names:
@@ -351,6 +682,196 @@ class Dictionary():
     ('Sleeping',None,None,64,'sleep'), 
     ('Grooming',None,None,65,'groom')]
 
+class _Lexicon(object):
+    """The dictionary with category names interned as ids, every word/stem maps to a bitmask of category ids.
+        Stems are kept as a sorted list rather than a character tree: the dictionary never nests one stem 
+        inside another (the tree couldn't hold that either), so the only stem that can prefix a word
+        is the greatest one that sorts before it.
+    """
+    def __init__(self, categories, lookup, stems):
+        self.categories = list(categories)
+        self._category_ids = dict((category, i) for i, category in enumerate(self.categories))
+        self._mask_ids = dict()
+        
+        self._words = dict() #word->(mask, rules)
+        for word, entries in lookup.items():
+            mask = self.category_mask(entries.get(Dictionary._TYPE_BASIC, ()))
+            rules = [(entry_type, conditions, if_set, if_not_set)
+                     for entry_type in entries if entry_type != Dictionary._TYPE_BASIC
+                     for conditions, if_set, if_not_set in entries[entry_type]]
+            self._words[word] = (mask, rules)
+        
+        flat_stems = dict()
+        def walk(node, prefix):
+            for char, child in node.items():
+                if isinstance(child, set):
+                    flat_stems[prefix+char] = self.category_mask(child)
+                else:
+                    walk(child, prefix+char)
+        walk(stems, '')
+        self._stems = sorted(flat_stems)
+        self._stem_masks = [flat_stems[stem] for stem in self._stems]
+    
+    def category_mask(self, categories):
+        mask = 0
+        for category in categories:
+            mask |= 1 << self._category_ids[category]
+        return mask
+    
+    def category_ids(self, mask):
+        if mask not in self._mask_ids:
+            self._mask_ids[mask] = tuple(i for i in range(len(self.categories)) if mask >> i & 1)
+        return self._mask_ids[mask]
+    
+    def category_names(self, mask):
+        return tuple(self.categories[i] for i in self.category_ids(mask))
+    
+    def find(self, word):
+        """Returns (mask, rules) for a word, exact entries win over stems, None if neither matches"""
+        if word in self._words:
+            return self._words[word]
+        i = bisect.bisect_right(self._stems, word) - 1
+        if i >= 0 and word.startswith(self._stems[i]):
+            return (self._stem_masks[i], [])
+        return None
+    
+    def rules(self):
+        """word->pre/post rules, for the words that have any"""
+        return dict((word, rules) for word, (mask, rules) in self._words.items() if rules)
+    
+    def words(self):
+        """(word, mask, rules) in sorted order"""
+        return [(word,)+self._words[word] for word in sorted(self._words, key=_utf8)]
+    
+    def stems(self):
+        """(stem, mask) in sorted order"""
+        return sorted(zip(self._stems, self._stem_masks), key=lambda stem: _utf8(stem[0]))
+    
+    #Compiled layout: a header, then sections, all native byte order (checked on load)
+    #  header: magic, version, byte order, mask width in bytes, #words, #stems, then (offset, length) per section
+    #  sections: category names, word key offsets, word keys, word masks, stem key offsets, stem keys, stem masks, rules
+    #  keys are utf-8 and sorted bytewise, key offsets are uint32 with one extra end offset, masks are fixed width little endian ints
+    #  rules (the handful of pre/post entries) are json
+    _MAGIC = b'LIWCDIC\0'
+    _VERSION = 1
+    _SECTIONS = ('categories', 'word_offsets', 'word_keys', 'word_masks', 'stem_offsets', 'stem_keys', 'stem_masks', 'rules')
+    _HEADER = struct.Struct('<8sIBIII' + 'II'*len(_SECTIONS))
+    
+    def save(self, filename):
+        mask_bytes = max(1, (len(self.categories)+7)//8)
+        words = self.words()
+        stems = self.stems()
+        def key_table(keys):
+            offsets = array('I', [0])
+            for key in keys:
+                offsets.append(offsets[-1]+len(_utf8(key)))
+            return offsets.tobytes(), b''.join(_utf8(key) for key in keys)
+        word_offsets, word_keys = key_table([word for word, mask, rules in words])
+        stem_offsets, stem_keys = key_table([stem for stem, mask in stems])
+        rules = dict((word, [[entry_type, list(conditions), sorted(if_set), sorted(if_not_set)]
+                             for entry_type, conditions, if_set, if_not_set in word_rules])
+                     for word, mask, word_rules in words if word_rules)
+        sections = {'categories': '\n'.join(self.categories).encode('utf-8'),
+                    'word_offsets': word_offsets, 'word_keys': word_keys,
+                    'word_masks': b''.join(mask.to_bytes(mask_bytes, 'little') for word, mask, rules in words),
+                    'stem_offsets': stem_offsets, 'stem_keys': stem_keys,
+                    'stem_masks': b''.join(mask.to_bytes(mask_bytes, 'little') for stem, mask in stems),
+                    'rules': json.dumps(rules, sort_keys=True).encode('utf-8')}
+        
+        position = _Lexicon._HEADER.size
+        layout = []
+        for name in _Lexicon._SECTIONS:
+            position += -position % 4 #keeps the uint32 sections aligned
+            layout.extend([position, len(sections[name])])
+            position += len(sections[name])
+        with open(filename, 'wb') as fout:
+            fout.write(_Lexicon._HEADER.pack(_Lexicon._MAGIC, _Lexicon._VERSION, sys.byteorder=='little',
+                                             mask_bytes, len(words), len(stems), *layout))
+            for name, offset in zip(_Lexicon._SECTIONS, layout[::2]):
+                fout.write(b'\0'*(offset-fout.tell()))
+                fout.write(sections[name])
+
+def _utf8(key):
+    return key.encode('utf-8')
+
+class _MappedLexicon(_Lexicon):
+    """A compiled lexicon searched in place inside a read-only memory map"""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fin:
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _Lexicon._HEADER.unpack_from(self._map)
+        magic, version, little_endian, self._mask_bytes, n_words, n_stems = header[:6]
+        if magic != _Lexicon._MAGIC or version != _Lexicon._VERSION:
+            raise ValueError(filename+" is not a compiled dictionary (or was compiled by another version)")
+        if little_endian != (sys.byteorder=='little'):
+            raise ValueError(filename+" was compiled on a machine with a different byte order")
+        self._sections = dict(zip(_Lexicon._SECTIONS, zip(header[6::2], header[7::2])))
+        
+        self.categories = self._section('categories').decode('utf-8').split('\n')
+        self._category_ids = dict((category, i) for i, category in enumerate(self.categories))
+        self._mask_ids = dict()
+        self._rules = dict((word, [(entry_type, conditions, set(if_set), set(if_not_set))
+                                   for entry_type, conditions, if_set, if_not_set in word_rules])
+                           for word, word_rules in json.loads(self._section('rules').decode('utf-8')).items())
+        self._word_table = self._table('word', n_words)
+        self._stem_table = self._table('stem', n_stems)
+    
+    def _section(self, name):
+        offset, length = self._sections[name]
+        return self._map[offset:offset+length]
+    
+    def _table(self, name, size):
+        offset, length = self._sections[name+'_offsets']
+        offsets = memoryview(self._map)[offset:offset+length].cast('I')
+        return offsets, self._sections[name+'_keys'][0], self._sections[name+'_masks'][0], size
+    
+    def _key(self, table, i):
+        offsets, keys, masks, size = table
+        return self._map[keys+offsets[i]:keys+offsets[i+1]]
+    
+    def _mask(self, table, i):
+        offsets, keys, masks, size = table
+        start = masks+i*self._mask_bytes
+        return int.from_bytes(self._map[start:start+self._mask_bytes], 'little')
+    
+    def _bisect(self, table, key):
+        """Index of the last key <= key, -1 if there is none"""
+        low, high = 0, table[3]
+        while low < high:
+            middle = (low+high)//2
+            if key < self._key(table, middle):
+                high = middle
+            else:
+                low = middle+1
+        return low-1
+    
+    def find(self, word):
+        key = _utf8(word)
+        i = self._bisect(self._word_table, key)
+        if i >= 0 and self._key(self._word_table, i) == key:
+            return (self._mask(self._word_table, i), self._rules.get(word, []))
+        i = self._bisect(self._stem_table, key)
+        if i >= 0 and key.startswith(self._key(self._stem_table, i)):
+            return (self._mask(self._stem_table, i), [])
+        return None
+    
+    def rules(self):
+        return self._rules
+    
+    def words(self):
+        return [(self._key(self._word_table, i).decode('utf-8'), self._mask(self._word_table, i), 
+                 self._rules.get(self._key(self._word_table, i).decode('utf-8'), [])) for i in range(self._word_table[3])]
+    
+    def stems(self):
+        return [(self._key(self._stem_table, i).decode('utf-8'), self._mask(self._stem_table, i)) for i in range(self._stem_table[3])]
+    
+    def __getstate__(self): #maps can't be pickled, worker processes reopen (and so share) the file instead
+        return {'filename': self.filename}
+    
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
 _dictionary_filename = None
 _dictionary = None
 
@@ -361,26 +882,135 @@ _dictionary = None
 #    pass
 
 
-def load_dictionary(dict_dir):
+_compiled_suffix = '.bin'
+
+def compile_dictionary(filename, compiled_filename=None):
+    """Parses a .dic file once and saves it next to it (or to compiled_filename) for load_dictionary()"""
+    if compiled_filename is None:
+        compiled_filename = filename + _compiled_suffix
+    Dictionary(filename).save_compiled(compiled_filename)
+    return compiled_filename
+
+def load_dictionary(dict_dir, cache_size=ResolutionCache.DEFAULT_SIZE, cache_policy='lru', vocabulary=None):
+    """Uses the compiled LIWC2007.dic.bin when it is at least as new as LIWC2007.dic, parses the .dic otherwise
+        @param vocabulary: Words (or a file of them) to warm the cache with, see Dictionary.warm_cache()
+    """
     global _dictionary
     dict_path = os.path.join(dict_dir, "LIWC2007.dic")
-    _dictionary = Dictionary(dict_path)
+    compiled_path = dict_path + _compiled_suffix
+    if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(dict_path):
+        _dictionary = Dictionary.load_compiled(compiled_path, cache_size=cache_size, cache_policy=cache_policy)
+    else:
+        _dictionary = Dictionary(dict_path, cache_size=cache_size, cache_policy=cache_policy)
+    if vocabulary is not None:
+        _dictionary.warm_cache(vocabulary)
+
+def open_dictionary(filename):
+    """A Dictionary from either a .dic file or a compiled one"""
+    with open(filename, 'rb') as fin:
+        compiled = fin.read(len(_Lexicon._MAGIC)) == _Lexicon._MAGIC
+    return Dictionary.load_compiled(filename) if compiled else Dictionary(filename)
+
+
+#Scoring many documents with a process pool
+#Documents are passed to the workers as (path, zip member or None), the workers read them themselves
+def find_documents(source):
+    """Lists the documents of a directory (recursively), a glob pattern, a zip archive or a single file"""
+    if os.path.isdir(source):
+        return [(os.path.join(directory, filename), None) for directory, subdirectories, filenames in sorted(os.walk(source))
+                for filename in sorted(filenames)]
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            return [(source, member) for member in archive.namelist()
+                    if not member.endswith('/') and not member.startswith('__MACOSX')]
+    if os.path.isfile(source):
+        return [(source, None)]
+    return [(filename, None) for filename in sorted(glob.glob(source)) if os.path.isfile(filename)]
+
+_archives = dict() #a worker opens each zip file once
+
+def _read_document(document, encoding='utf-8'):
+    path, member = document
+    if member is None:
+        with open(path, encoding=encoding, errors='replace') as fin:
+            return fin.read()
+    if path not in _archives:
+        _archives[path] = zipfile.ZipFile(path)
+    return _archives[path].read(member).decode(encoding, 'replace')
+
+def _document_name(document):
+    path, member = document
+    return path if member is None else path+':'+member
+
+def _init_worker(dictionary_filename):
+    global _dictionary
+    _dictionary = open_dictionary(dictionary_filename)
+
+def _score_document(args):
+    document, raw_counts = args
+    return _document_name(document), score_text(_read_document(document), raw_counts=raw_counts)
+
+def score_documents(documents, dictionary_filename, processes=None, raw_counts=False, chunksize=16):
+    """Scores documents (see find_documents()) over a pool of processes, each loading the dictionary once.
+        Yields (document name, scores) in the order of documents.
+    """
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(dictionary_filename,))
+    try:
+        for result in pool.imap(_score_document, [(document, raw_counts) for document in documents], chunksize):
+            yield result
+    finally:
+        pool.terminate()
+
+def write_scores(results, fout, output_format='csv', categories=None):
+    """Writes (document name, scores) pairs as csv (a column per category, needs categories) or as json lines"""
+    if output_format == 'csv':
+        writer = csv.writer(fout)
+        writer.writerow(['Filename'] + categories)
+        for name, scores in results:
+            writer.writerow([name] + [scores[category] for category in categories])
+    elif output_format == 'jsonl':
+        for name, scores in results:
+            fout.write(json.dumps({'filename': name, 'scores': scores}, sort_keys=True)+'\n')
+    else:
+        raise ValueError("output format should be 'csv' or 'jsonl', not "+repr(output_format))
 
 
 
 if( __name__ == '__main__'):
-    if not 2 <= len(sys.argv) <= 3:
+    import argparse
+    parser = argparse.ArgumentParser(description='LIWC style word category counts')
+    parser.add_argument('source', nargs='?', help='A file to score, or with -p/-o a directory, glob pattern or zip archive of them')
+    parser.add_argument('dictionary', nargs='?', help='The .dic (or compiled) dictionary file')
+    parser.add_argument('--compile', dest='compile', metavar='DIC', help='Compile a .dic file for load_dictionary() and exit')
+    parser.add_argument('-p', dest='processes', type=int, default=None, help='Number of worker processes (default: one per core)')
+    parser.add_argument('-o', dest='output', default=None, help='Output file for the scores (default: stdout)')
+    parser.add_argument('-f', dest='output_format', choices=['csv', 'jsonl'], default='csv', help='Output format')
+    parser.add_argument('--raw', dest='raw_counts', action='store_true', help='Write counts instead of percentages')
+    args = parser.parse_args()
+    
+    if args.compile is not None:
+        print(compile_dictionary(args.compile))
+    elif args.source is None:
         print('Sample:')
         txt = """The quick brown fox jumps over the very lazy dog."""
         print(txt)
         print(score_text(txt))
         print()
-        sys.stderr.write("Usage: word_category_counter.py filename_to_process\n")
+        parser.print_usage(sys.stderr)
+    elif os.path.isfile(args.source) and not zipfile.is_zipfile(args.source) and args.processes is None and args.output is None:
+        if args.dictionary is not None:
+            _dictionary_filename = args.dictionary
+            _dictionary = open_dictionary(_dictionary_filename)
+        print(score_file(args.source, raw_counts=args.raw_counts))
     else:
-        filename = sys.argv[1]
-        if len(sys.argv) > 2:
-            _dictionary_filename = sys.argv[2]
-            _dictionary=Dictionary(_dictionary_filename)
-        print(score_file(filename))
+        if args.dictionary is None:
+            parser.error('scoring many documents needs the dictionary file')
+        _dictionary = open_dictionary(args.dictionary)
+        categories = _dictionary.category_names() + ['Sentences', 'Unique Words', 'Words Per Sentence']
+        results = score_documents(find_documents(args.source), args.dictionary, args.processes, args.raw_counts)
+        fout = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+        write_scores(results, fout, args.output_format, categories)
+        if fout is not sys.stdout:
+            fout.close()
 
 
@@ -0,0 +1,115 @@
+import zlib
+from collections import namedtuple
+
+import numpy
+import scipy.sparse
+
+
+CollisionInfo = namedtuple("CollisionInfo", ["features", "columns", "collisions"])
+
+
+class FeatureHasher(object):
+    """
+    Maps feature dictionaries into a fixed width sparse feature space with
+    the hashing trick, so no vocabulary has to be kept in memory.
+
+    A feature name is hashed with CRC32 (stable between runs and processes,
+    unlike hash()); the hash modulo n_features is its column and, when
+    signed, the top bit of the hash picks the sign of its value so that
+    colliding features tend to cancel out rather than add up. Integer keys
+    are taken to already be hashes.
+
+    It can be used in place of a FeatureVocabulary: it needs no fitting and
+    maps the features of any data set to the same columns.
+
+    hasher = FeatureHasher(n_features=2 ** 18)
+    X = hasher.transform(feature_dicts)
+
+    :param n_features: the number of columns
+    :param signed: use signed hashing
+    :param track_collisions: remember which feature was first seen in each
+        column so collision_info() can report how many features share a
+        column; this keeps a dictionary as large as the vocabulary
+    """
+
+    def __init__(self, n_features=2 ** 20, signed=True, track_collisions=False):
+        if n_features < 1:
+            raise ValueError("n_features must be positive, not {}".format(n_features))
+        self.n_features = n_features
+        self.signed = signed
+        self.track_collisions = track_collisions
+        self._seen = {}
+        self._collided = set()
+
+    def index(self, key):
+        """
+        :param key: a feature name, or an integer hash
+        :return: (column, sign)
+        """
+        if isinstance(key, int):
+            h = key & 0xffffffff
+        else:
+            h = zlib.crc32(key.encode("utf-8")) & 0xffffffff
+        sign = -1 if self.signed and h & 0x80000000 else 1
+        return h % self.n_features, sign
+
+    def transform_one(self, features):
+        """
+        :param features: a feature dictionary
+        :return: {column: value}, with the values of colliding features summed
+        """
+        row = {}
+        for key, value in features.items():
+            column, sign = self.index(key)
+            if self.track_collisions:
+                first = self._seen.setdefault(column, key)
+                if first != key:
+                    self._collided.add(key)
+            row[column] = row.get(column, 0.0) + sign * float(value)
+        return row
+
+    def transform(self, feature_dicts):
+        """
+        :param feature_dicts: an iterable of feature dictionaries
+        :return: a scipy.sparse.csr_matrix with a row per dictionary
+        """
+        indptr = [0]
+        indices = []
+        data = []
+        for features in feature_dicts:
+            row = self.transform_one(features)
+            for column in sorted(row):
+                if row[column] != 0.0:
+                    indices.append(column)
+                    data.append(row[column])
+            indptr.append(len(indices))
+        return scipy.sparse.csr_matrix(
+            (numpy.asarray(data, dtype=numpy.float64), numpy.asarray(indices, dtype=numpy.int32), numpy.asarray(indptr, dtype=numpy.int64)),
+            shape=(len(indptr) - 1, self.n_features))
+
+    def transform_labeled(self, feature_category_tuples):
+        """
+        :param feature_category_tuples: [(feature dictionary, category)], as
+            returned by get_features_category_tuples()
+        :return: (csr_matrix, list of categories)
+        """
+        labels = []
+        def features():
+            for feature_vectors, category in feature_category_tuples:
+                labels.append(category)
+                yield feature_vectors
+        return self.transform(features()), labels
+
+    def collision_info(self):
+        """
+        :return: CollisionInfo(features, columns, collisions): the number of
+            distinct features seen, the columns they occupy and how many of
+            them landed in a column already taken by another feature
+        """
+        if not self.track_collisions:
+            raise ValueError("collision_info() needs track_collisions=True")
+        return CollisionInfo(len(self._seen) + len(self._collided), len(self._seen), len(self._collided))
+
+    def clear_collisions(self):
+        self._seen.clear()
+        self._collided.clear()
@@ -0,0 +1,265 @@
+import argparse
+import ast
+import json
+import re
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+
+import numpy
+import scipy.sparse
+
+
+# magic, flags, features version, rows, columns, stored values, then the
+# stored size in bytes of each section: indptr, indices, data, feature names, labels
+_MAGIC = b'FEATSET\0'
+_HEADER = struct.Struct('<8sIIQQQQQQQQ')
+_COMPRESSED = 1
+_WIDE_INDICES = 2
+_ALIGN = 8
+
+FeatureSet = namedtuple("FeatureSet", ["matrix", "labels", "feature_names", "version"])
+
+
+def _padding(size):
+    return -size % _ALIGN
+
+
+def write_feature_matrix(path, matrix, labels, feature_names, version=0, compress=False):
+    """
+    Saves a feature matrix in the binary feature set format: a header, the
+    CSR arrays of the matrix and a JSON table of the feature names and labels.
+    Each section starts on an 8 byte boundary so an uncompressed file can be
+    memory mapped by read_feature_set().
+
+    :param matrix: scipy.sparse matrix with a row per text
+    :param labels: the category of each row
+    :param feature_names: the feature name of each column
+    :param version: the FEATURES_VERSION of the extractors, see read_feature_set()
+    :param compress: zlib compress each section, smaller but read into memory
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    n_rows, n_columns = matrix.shape
+    flags = _COMPRESSED if compress else 0
+    wide = matrix.nnz >= 2 ** 31 or n_columns >= 2 ** 31
+    index_dtype = numpy.int64 if wide else numpy.int32
+    if wide:
+        flags |= _WIDE_INDICES
+    sections = [numpy.ascontiguousarray(matrix.indptr, dtype=index_dtype).tobytes(),
+                numpy.ascontiguousarray(matrix.indices, dtype=index_dtype).tobytes(),
+                numpy.ascontiguousarray(matrix.data, dtype=numpy.float64).tobytes(),
+                json.dumps(list(feature_names)).encode("utf-8"),
+                json.dumps([str(label) for label in labels]).encode("utf-8")]
+    if compress:
+        sections = [zlib.compress(section) for section in sections]
+    with open(path, "wb") as fout:
+        fout.write(_HEADER.pack(_MAGIC, flags, version, n_rows, n_columns, matrix.nnz, *[len(section) for section in sections]))
+        fout.write(b'\0' * _padding(_HEADER.size))
+        for section in sections:
+            fout.write(section)
+            fout.write(b'\0' * _padding(len(section)))
+
+
+def feature_rows(features_category_tuples, columns=None):
+    """
+    Turns (feature dictionary, category) tuples into sparse rows, one at a
+    time, e.g. feature_rows(read_features_category(fname)) to stream a text
+    dump. Columns are numbered in the order the features are first seen and
+    values of 0 are kept, since the nltk classifiers treat them as features
+    too.
+
+    :param columns: dict feature name -> column, new features are added to
+        it as they are seen
+    :return: a generator of (column indices, values, category), the first
+        two as numpy arrays
+    :raise ValueError: for a feature value that is not a number, e.g. None
+    """
+    if columns is None:
+        columns = {}
+    for feature_vectors, category in features_category_tuples:
+        row_indices = array('q')
+        for name in feature_vectors:
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = len(columns)
+            row_indices.append(column)
+        try:
+            values = array('d', feature_vectors.values())
+        except TypeError:
+            name, value = next((name, value) for name, value in feature_vectors.items() if not isinstance(value, (int, float)))
+            raise ValueError("feature {!r} of a {} text has the value {!r}, feature sets only hold numbers".format(name, category, value))
+        yield numpy.frombuffer(row_indices, dtype=numpy.int64), numpy.frombuffer(values, dtype=numpy.float64), category
+
+
+def write_feature_set(path, features_category_tuples, version=0, compress=False):
+    """
+    Saves the (feature dictionary, category) tuples returned by
+    get_features_category_tuples(), with columns numbered by feature_rows().
+    """
+    columns = {}
+    indptr = array('q', [0])
+    indices = array('q')
+    data = array('d')
+    labels = []
+    for row_indices, values, category in feature_rows(features_category_tuples, columns):
+        indices.frombytes(row_indices.tobytes())
+        data.frombytes(values.tobytes())
+        indptr.append(len(indices))
+        labels.append(category)
+    matrix = scipy.sparse.csr_matrix(
+        (numpy.frombuffer(data, dtype=numpy.float64), numpy.frombuffer(indices, dtype=numpy.int64), numpy.frombuffer(indptr, dtype=numpy.int64)),
+        shape=(len(labels), len(columns)))
+    feature_names = [None] * len(columns)
+    for name, column in columns.items():
+        feature_names[column] = name
+    write_feature_matrix(path, matrix, labels, feature_names, version=version, compress=compress)
+
+
+def read_feature_set(path, mmap=True):
+    """
+    Loads a feature set saved by write_feature_set() or write_feature_matrix().
+
+    :param mmap: memory map the matrix of an uncompressed file instead of
+        reading it
+    :return: FeatureSet(matrix, labels, feature_names, version): a
+        scipy.sparse.csr_matrix, a numpy array of the categories, the list of
+        feature names and the features version the file was written with
+    """
+    with open(path, "rb") as fin:
+        header = fin.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("{} is not a feature set file".format(path))
+        fields = _HEADER.unpack(header)
+        flags, version, n_rows, n_columns, nnz = fields[1:6]
+        sizes = fields[6:]
+        index_dtype = numpy.int64 if flags & _WIDE_INDICES else numpy.int32
+        counts = [n_rows + 1, nnz, nnz]
+        dtypes = [index_dtype, index_dtype, numpy.float64]
+
+        offsets = []
+        offset = _HEADER.size + _padding(_HEADER.size)
+        for size in sizes:
+            offsets.append(offset)
+            offset += size + _padding(size)
+
+        arrays = []
+        for offset, size, count, dtype in zip(offsets, sizes, counts, dtypes):
+            if flags & _COMPRESSED:
+                fin.seek(offset)
+                arrays.append(numpy.frombuffer(zlib.decompress(fin.read(size)), dtype=dtype))
+            elif mmap and count > 0:
+                arrays.append(numpy.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)))
+            else:
+                fin.seek(offset)
+                arrays.append(numpy.frombuffer(fin.read(size), dtype=dtype))
+
+        tables = []
+        for offset, size in zip(offsets[3:], sizes[3:]):
+            fin.seek(offset)
+            table = fin.read(size)
+            if flags & _COMPRESSED:
+                table = zlib.decompress(table)
+            tables.append(json.loads(table.decode("utf-8")))
+
+    indptr, indices, data = arrays
+    feature_names, labels = tables
+    matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_columns), copy=False)
+    return FeatureSet(matrix, numpy.array(labels), feature_names, version)
+
+
+def feature_category_tuples(feature_set):
+    """
+    Turns a FeatureSet back into the [(feature dictionary, category)] the
+    nltk classifiers train on.
+    """
+    names = feature_set.feature_names
+    matrix = feature_set.matrix
+    indptr = matrix.indptr.tolist()
+    indices = matrix.indices.tolist()
+    data = matrix.data.tolist()
+    features_category_tuples = []
+    for row, category in enumerate(feature_set.labels.tolist()):
+        start, end = indptr[row], indptr[row + 1]
+        features_category_tuples.append(({names[column]: value for column, value in zip(indices[start:end], data[start:end])}, category))
+    return features_category_tuples
+
+
+# one "key: value, " item of a feature dictionary as written by str(dict),
+# keys with escapes or that are not strings are left to ast.literal_eval()
+_ITEM = re.compile(r"""(?:'([^'\\]*)'|"([^"\\]*)"): ([^,]+)(, |$)""")
+_CONSTANTS = {"True": True, "False": False}
+
+
+def _parse_value(text):
+    if text in _CONSTANTS:
+        return _CONSTANTS[text]
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_feature_dict(text):
+    """
+    Parses the str() of a feature dictionary, as written by
+    write_features_category(), without eval. The items are matched with one
+    regular expression; if they do not make up the whole dictionary, e.g.
+    because of escaped or non-string keys, it is handed to ast.literal_eval().
+    """
+    if not (text.startswith("{") and text.endswith("}")):
+        raise ValueError("not a feature dictionary: {!r}".format(text[:50]))
+    body = text[1:-1]
+    features = {}
+    values = {}
+    parsed = 0
+    try:
+        for single_quoted, double_quoted, value, separator in _ITEM.findall(body):
+            key = single_quoted or double_quoted
+            parsed += len(key) + len(value) + len(separator) + 4
+            parsed_value = values.get(value)
+            if parsed_value is None:
+                parsed_value = values[value] = _parse_value(value)
+            features[key] = parsed_value
+    except ValueError:
+        parsed = -1
+    if parsed != len(body):
+        return ast.literal_eval(text)
+    return features
+
+
+def read_features_category(fname):
+    """
+    Reads a "<category>\\t<feature dictionary>" text dump written by
+    write_features_category() one line at a time.
+
+    :return: a generator of (feature dictionary, category) tuples
+    """
+    with open(fname, "r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            category, features = line.split("\t", 1)
+            yield parse_feature_dict(features), category.rstrip()
+
+
+def convert_features_file(txt_fname, bin_fname, version=0, compress=False):
+    """
+    Converts a text dump written by write_features_category() to the binary
+    feature set format, without holding its dictionaries in memory.
+    """
+    write_feature_set(bin_fname, read_features_category(txt_fname), version=version, compress=compress)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts -features.txt dumps to binary feature set files")
+    parser.add_argument("fnames", nargs="+", help="the -features.txt files, each is written next to it with a .bin suffix")
+    parser.add_argument("-z", dest="compress", action="store_true", help="compress the feature sets")
+    parser.add_argument("-v", dest="version", type=int, default=0, help="the features version to record")
+    args = parser.parse_args()
+
+    for fname in args.fnames:
+        bin_fname = re.sub(r"\.txt$", "", fname) + ".bin"
+        convert_features_file(fname, bin_fname, version=args.version, compress=args.compress)
+        print("{} -> {}".format(fname, bin_fname))
@@ -1,9 +1,14 @@
 
+import nltk
 from nltk.corpus import opinion_lexicon
 import re
 import word_category_counter
 import data_helper
 import os, sys
+import multiprocessing
+from collections import Counter, namedtuple
+import numpy
+import scipy.sparse
 from word2vec_extractor import Word2vecExtractor
 DATA_DIR = "asg4-data/data"
 LIWC_DIR = "asg4-data/liwc"
@@ -18,6 +23,9 @@ w2v = None
 FEATURE_SETS = {"word_features", "word_pos_features", "word_pos_liwc_features", "word_pos_opinion_features",
                "word_embedding", "best_features"}
 
+# Bump when an extractor changes, so cached features from older code are not reused
+FEATURES_VERSION = 1
+
 def binning(count):
     """
     Results in bins of  0, 1, 2, 3 >=
@@ -126,9 +134,31 @@ def get_liwc_features(words):
     :return:
     """
 
-    feature_vectors = {}
     text = " ".join(words)
     liwc_scores = word_category_counter.score_text(text)
+    return liwc_feature_vectors(liwc_scores)
+
+
+def get_liwc_features_many(words_lists):
+    """
+    get_liwc_features for a whole batch of tokenized texts, scored with
+    a single word_category_counter.score_many call.
+
+    :param words_lists: list of lists of words
+    :return: list of feature dictionaries, one per text
+    """
+    matrix, category_names = word_category_counter.score_many([" ".join(words) for words in words_lists])
+    return [liwc_feature_vectors(Counter(dict(zip(category_names, row)))) for row in matrix.tolist()]
+
+
+def liwc_feature_vectors(liwc_scores):
+    """
+    Builds the LIWC features from the scores of one text.
+
+    :param liwc_scores: Counter of category name -> score, as from score_text
+    :return: feature_vectors: a dictionary values for each LIWC feature
+    """
+    feature_vectors = {}
 
     # All possible keys to the scores start on line 269
     # of the word_category_counter.py script
@@ -144,14 +174,49 @@ def get_liwc_features(words):
 
     return feature_vectors
 
+def get_w2v():
+    """
+    :return: the Word2vecExtractor for w2vecmodel, loaded on first use
+    """
+    global w2v
+    if w2v is None:
+        w2v = Word2vecExtractor(w2vecmodel)
+    return w2v
+
+
 def get_word_embedding_features(text):
     feature_vectors = {}
 
     # TODO: NEWLY ADDED, YOUR CODE GOES HERE
-    raise NotImplemented
+    feature_vectors.update(get_w2v().get_doc2vec_feature_dict(text))
     return feature_vectors
 
 
+def get_word_embedding_vectors(texts):
+    """
+    The word embedding features of many texts as one dense block, without a
+    dictionary per text.
+
+    :return: array of shape (len(texts), vector size)
+    """
+    return get_w2v().docs2vec(texts)
+
+
+def get_word_embedding_names():
+    """
+    :return: the names get_word_embedding_features() gives the columns of
+        get_word_embedding_vectors()
+    """
+    return get_w2v().feature_names()
+
+
+DenseBlock = namedtuple("DenseBlock", ["vectors", "feature_names"])
+
+# Feature sets made of dense features: with as_matrix=True they are computed
+# for all the texts at once and the matrix is the numpy array itself
+DENSE_FEATURE_BLOCKS = {"word_embedding": DenseBlock(get_word_embedding_vectors, get_word_embedding_names)}
+
+
 def get_opinion_features(tags):
     """
     This function creates the opinion lexicon features
@@ -178,13 +243,130 @@ def get_opinion_features(tags):
     return feature_vectors
 
 
-def get_features_category_tuples(category_text_dict, feature_set):
+def get_feature_vectors(text, feature_set):
+    """
+    Extracts the features of one text.
+
+    :param text:
+    :param feature_set:
+    :return: feature_vectors: a dictionary of feature values
+    """
+    if feature_set == "word_embedding":
+        return get_word_embedding_features(text)
+
+    words, tags = get_words_tags(text)
+    feature_vectors = {}
+
+    ###     YOUR CODE GOES HERE
+    # TODO: best_features is for competition
+    raise NotImplemented
+
+    return feature_vectors
+
+
+def _init_worker(feature_set):
+    """
+    Loads what the extractors of feature_set use once per worker process,
+    the LIWC dictionary is loaded when this module is imported. Whatever
+    fails to load is left to fail in the extractors, where the error reaches
+    the caller; an exception here would only make the pool start new
+    workers forever.
+    """
+    try:
+        words = nltk.word_tokenize(" ".join(nltk.sent_tokenize("Loading the tokenizer.")))
+        if feature_set == "word_embedding":
+            get_w2v()
+        else:
+            nltk.pos_tag(words)
+    except (LookupError, OSError):
+        pass
+
+
+def _get_feature_vectors(args):
+    text, feature_set = args
+    return get_feature_vectors(text, feature_set)
+
+
+FeatureMatrix = namedtuple("FeatureMatrix", ["matrix", "labels", "vocabulary"])
+
+
+class FeatureVocabulary(object):
+    """
+    Maps feature names to matrix columns. Fit it on the training data and
+    reuse it for the development and testing data, where features it has not
+    seen are dropped.
+    """
+
+    def __init__(self, feature_names=()):
+        self.columns = {name: column for column, name in enumerate(feature_names)}
+
+    def __len__(self):
+        return len(self.columns)
+
+    def feature_names(self):
+        names = [None] * len(self.columns)
+        for name, column in self.columns.items():
+            names[column] = name
+        return names
+
+    def fit(self, feature_dicts):
+        for feature_vectors in feature_dicts:
+            for name in feature_vectors:
+                if name not in self.columns:
+                    self.columns[name] = len(self.columns)
+        return self
+
+    def transform(self, feature_dicts, grow=False):
+        """
+        :param feature_dicts: an iterable of feature dictionaries
+        :param grow: add unseen features as new columns instead of dropping them
+        :return: a scipy.sparse.csr_matrix with a row per dictionary
+        """
+        columns = self.columns
+        indptr = [0]
+        indices = []
+        data = []
+        for feature_vectors in feature_dicts:
+            for name, value in feature_vectors.items():
+                column = columns.get(name)
+                if column is None:
+                    if not grow:
+                        continue
+                    column = columns[name] = len(columns)
+                indices.append(column)
+                data.append(value)
+            indptr.append(len(indices))
+        matrix = scipy.sparse.csr_matrix(
+            (numpy.asarray(data, dtype=numpy.float64), numpy.asarray(indices, dtype=numpy.int32), numpy.asarray(indptr, dtype=numpy.int64)),
+            shape=(len(indptr) - 1, len(columns)))
+        matrix.sort_indices()
+        return matrix
+
+    def fit_transform(self, feature_dicts):
+        return self.transform(feature_dicts, grow=True)
+
+
+def get_features_category_tuples(category_text_dict, feature_set, cache=None, workers=1, as_matrix=False, vocabulary=None):
     """
 
     You will might want to update the code here for the competition part.
 
     :param category_text_dict:
     :param feature_set:
+    :param cache: optional feature_cache.FeatureCache, features found there
+        are not extracted again and new ones are added to it
+    :param workers: number of processes to extract features with, results
+        keep the order of the texts
+    :param as_matrix: return a FeatureMatrix(matrix, labels, vocabulary)
+        instead of the (feature dictionary, category) tuples: a
+        scipy.sparse.csr_matrix with a row per text, or the numpy array of
+        the DENSE_FEATURE_BLOCKS feature sets, and a numpy array of the
+        categories
+    :param vocabulary: the FeatureVocabulary, or feature_hashing.FeatureHasher,
+        to use with as_matrix, a new FeatureVocabulary is fitted on these
+        texts when None; for DENSE_FEATURE_BLOCKS feature sets it is one of
+        the names of their columns, so their feature dictionaries can be
+        turned into the same matrix
     :return:
     """
     features_category_tuples = []
@@ -192,19 +374,53 @@ def get_features_category_tuples(category_text_dict, feature_set):
 
     assert feature_set in FEATURE_SETS, "unrecognized feature set:{}, Accepted values:{}".format(feature_set, FEATURE_SETS)
 
+    categories = []
     for category in category_text_dict:
         for text in category_text_dict[category]:
-
-            words, tags = get_words_tags(text)
-            feature_vectors = {}
-
-            ###     YOUR CODE GOES HERE
-            # TODO: best_features is for competition
-            raise NotImplemented
-
-            features_category_tuples.append((feature_vectors, category))
+            categories.append(category)
             all_texts.append(text)
 
+    if as_matrix and feature_set in DENSE_FEATURE_BLOCKS:
+        dense_block = DENSE_FEATURE_BLOCKS[feature_set]
+        if vocabulary is None:
+            vocabulary = FeatureVocabulary(dense_block.feature_names())
+        return FeatureMatrix(dense_block.vectors(all_texts), numpy.array(categories), vocabulary), all_texts
+
+    all_feature_vectors = [None] * len(all_texts)
+    if cache is not None:
+        all_feature_vectors = [cache.get(text, feature_set) for text in all_texts]
+    missing = [i for i in range(len(all_texts)) if all_feature_vectors[i] is None]
+
+    jobs = [(all_texts[i], feature_set) for i in missing]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(feature_set,))
+        try:
+            new_feature_vectors = pool.map(_get_feature_vectors, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        new_feature_vectors = [_get_feature_vectors(job) for job in jobs]
+
+    for i, feature_vectors in zip(missing, new_feature_vectors):
+        all_feature_vectors[i] = feature_vectors
+        if cache is not None:
+            cache.put(all_texts[i], feature_set, feature_vectors)
+
+    if cache is not None:
+        cache.commit()
+
+    if as_matrix:
+        if vocabulary is None:
+            vocabulary = FeatureVocabulary()
+            matrix = vocabulary.fit_transform(all_feature_vectors)
+        else:
+            matrix = vocabulary.transform(all_feature_vectors)
+        return FeatureMatrix(matrix, numpy.array(categories), vocabulary), all_texts
+
+    for feature_vectors, category in zip(all_feature_vectors, categories):
+        features_category_tuples.append((feature_vectors, category))
+
     return features_category_tuples, all_texts
 
 
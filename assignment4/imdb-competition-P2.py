@@ -7,7 +7,10 @@ from sklearn.neural_network import multilayer_perceptron
 import nltk, pickle, argparse
 import os, random
 import data_helper
-from features import get_features_category_tuples
+from features import get_features_category_tuples, FeatureMatrix, FeatureVocabulary, DENSE_FEATURE_BLOCKS, FEATURES_VERSION
+from feature_cache import FeatureCache
+from feature_hashing import FeatureHasher
+from feature_store import write_feature_set, write_feature_matrix, read_feature_set, feature_category_tuples
 
 random.seed(10)
 DATA_DIR = "asg4-data/data"
@@ -16,6 +19,32 @@ DATA_DIR = "asg4-data/data"
 # TODO: You can expand this feature set
 CLASSIFIER_SETS = {"nb", "nb_sklearn", "dt", "dt_sklearn", "svm_sklearn", "nn_sklearn"}
 
+# These train on the features as a sparse matrix rather than dictionaries
+SKLEARN_CLASSIFIERS = {"nb_sklearn", "dt_sklearn", "svm_sklearn", "nn_sklearn"}
+
+
+class MatrixClassifier(object):
+    """
+    A fitted sklearn estimator together with the FeatureVocabulary of its
+    training data, or the FeatureHasher it was trained with, so it can be
+    saved and used like the nltk classifiers. For a DENSE_FEATURE_BLOCKS
+    feature set the vocabulary holds the names of the dense columns, so it
+    classifies the feature dictionaries get_feature_vectors() gives them.
+    """
+
+    def __init__(self, estimator, vocabulary):
+        self.estimator = estimator
+        self.vocabulary = vocabulary
+
+    def labels(self):
+        return list(self.estimator.classes_)
+
+    def classify_many(self, featuresets):
+        return list(self.estimator.predict(self.vocabulary.transform(featuresets)))
+
+    def classify(self, featureset):
+        return self.classify_many([featureset])[0]
+
 
 def build_classifier(classifier_type):
     """
@@ -28,6 +57,16 @@ def build_classifier(classifier_type):
 
     if classifier_type == "nb":
         cls = nltk.classify.NaiveBayesClassifier
+    elif classifier_type == "dt":
+        cls = nltk.classify.DecisionTreeClassifier
+    elif classifier_type == "nb_sklearn":
+        cls = BernoulliNB()
+    elif classifier_type == "dt_sklearn":
+        cls = tree.DecisionTreeClassifier(random_state=10)
+    elif classifier_type == "svm_sklearn":
+        cls = svm.LinearSVC()
+    elif classifier_type == "nn_sklearn":
+        cls = multilayer_perceptron.MLPClassifier(random_state=10)
     else:
         raise NotImplemented
 
@@ -61,6 +100,9 @@ def save_classifier(classifier, classifier_fname):
 def evaluate(classifier, features_category_tuples, reference_text, data_set_name=None):
 
     ###     YOUR CODE GOES HERE
+    if isinstance(features_category_tuples, FeatureMatrix):
+        return evaluate_matrix(classifier, features_category_tuples, data_set_name)
+
     accuracy = nltk.classify.accuracy(classifier, features_category_tuples)
 
 
@@ -85,7 +127,44 @@ def evaluate(classifier, features_category_tuples, reference_text, data_set_name
     return accuracy, confusion_matrix
 
 
-def build_features(data_file, feat_name, save_feats=None, binning=False):
+def evaluate_matrix(classifier, feature_matrix, data_set_name=None):
+    predicted_labels = list(classifier.estimator.predict(feature_matrix.matrix))
+    reference_labels = list(feature_matrix.labels)
+    accuracy = sum(1 for p, r in zip(predicted_labels, reference_labels) if p == r) / len(reference_labels)
+
+    accuracy_results_file = open("{}_results.txt".format(data_set_name), 'w', encoding='utf-8')
+    accuracy_results_file.write('Results of {}:\n\n'.format(data_set_name))
+    accuracy_results_file.write("{0:10s} {1:8.5f}\n\n".format("Accuracy", accuracy))
+
+    confusion_matrix = nltk.ConfusionMatrix(reference_labels, predicted_labels)
+
+    accuracy_results_file.write(str(confusion_matrix))
+    accuracy_results_file.write('\n\n')
+    accuracy_results_file.close()
+
+    return accuracy, confusion_matrix
+
+
+def saved_features_fname(feats_dir, data_file, feat_name):
+    return os.path.join(feats_dir, "{}-{}.features.bin".format(feat_name, os.path.splitext(data_file)[0]))
+
+
+def load_saved_features(feats_dir, data_file, feat_name):
+    """
+    :return: the features saved in feats_dir by an earlier run, or None when
+        there are none or they are older than the data or the extractors
+    """
+    fname = saved_features_fname(feats_dir, data_file, feat_name)
+    if not os.path.exists(fname) or os.path.getmtime(fname) < os.path.getmtime(os.path.join(DATA_DIR, data_file)):
+        return None
+    feature_set = read_feature_set(fname)
+    if feature_set.version != FEATURES_VERSION:
+        return None
+    return feature_set
+
+
+def build_features(data_file, feat_name, save_feats=None, binning=False, cache=None, workers=1, as_matrix=False, vocabulary=None,
+                   feats_dir=None):
     # TODO: YOUR CODE GOES HERE: you need to handle if binning=True
     # read text data
     raw_data = data_helper.read_file(os.path.join(DATA_DIR, data_file))
@@ -93,33 +172,69 @@ def build_features(data_file, feat_name, save_feats=None, binning=False):
 
     category_texts = {"positive": positive_texts, "negative": negative_texts}
 
+    # the saved feature sets only hold dictionary features
+    if as_matrix and feat_name in DENSE_FEATURE_BLOCKS:
+        feats_dir = None
+
+    # reuse the features saved by an earlier run
+    if feats_dir is not None:
+        feature_set = load_saved_features(feats_dir, data_file, feat_name)
+        if feature_set is not None:
+            texts = positive_texts + negative_texts
+            if not as_matrix:
+                return feature_category_tuples(feature_set), texts
+            if vocabulary is None:
+                return FeatureMatrix(feature_set.matrix, feature_set.labels, FeatureVocabulary(feature_set.feature_names)), texts
+            return FeatureMatrix(vocabulary.transform(features for features, _ in feature_category_tuples(feature_set)), feature_set.labels, vocabulary), texts
+
     # build features
-    features_category_tuples, texts = get_features_category_tuples(category_texts, feat_name)
+    features_category_tuples, texts = get_features_category_tuples(category_texts, feat_name, cache=cache, workers=workers,
+                                                                   as_matrix=as_matrix, vocabulary=vocabulary)
 
     # save features to file
-    if save_feats is not None:
+    if save_feats is not None and not as_matrix:
         write_features_category(features_category_tuples, save_feats)
+    if feats_dir is not None:
+        os.makedirs(feats_dir, exist_ok=True)
+        feats_fname = saved_features_fname(feats_dir, data_file, feat_name)
+        if not as_matrix:
+            write_feature_set(feats_fname, features_category_tuples, version=FEATURES_VERSION)
+        elif vocabulary is None:
+            # a matrix made with another data set's vocabulary is missing the features it has not seen
+            write_feature_matrix(feats_fname, features_category_tuples.matrix, features_category_tuples.labels,
+                                 features_category_tuples.vocabulary.feature_names(), version=FEATURES_VERSION)
 
     return features_category_tuples, texts
 
 
 
-def train_model(datafile, feature_set, cls_name, save_model=None):
+def train_model(datafile, feature_set, cls_name, save_model=None, cache=None, workers=1, feats_dir=None, hasher=None):
 
-    features_data, texts = build_features(datafile, feature_set)
-
-    classifier = build_classifier(cls_name).train(features_data)
+    if cls_name in SKLEARN_CLASSIFIERS:
+        # a hasher takes the place of the vocabulary fitted on the training
+        # data, dense features have a fixed width and are not hashed
+        if feature_set in DENSE_FEATURE_BLOCKS:
+            hasher = None
+        features_data, texts = build_features(datafile, feature_set, cache=cache, workers=workers, as_matrix=True, vocabulary=hasher,
+                                              feats_dir=feats_dir)
+        estimator = build_classifier(cls_name)
+        estimator.fit(features_data.matrix, features_data.labels)
+        classifier = MatrixClassifier(estimator, features_data.vocabulary)
+    else:
+        features_data, texts = build_features(datafile, feature_set, cache=cache, workers=workers, feats_dir=feats_dir)
+        classifier = build_classifier(cls_name).train(features_data)
     if save_model is not None:
         save_classifier(classifier, save_model)
         print('saved model {}'.format(save_model))
     return classifier
 
 
-def train_eval(train_file, feature_set, cls_name, cls_fname, eval_file=None, is_train=True):
+def train_eval(train_file, feature_set, cls_name, cls_fname, eval_file=None, is_train=True, cache=None, workers=1, feats_dir=None,
+               hasher=None):
 
     # train or get saved model
     if is_train:
-        model = train_model(train_file, feature_set, cls_name)
+        model = train_model(train_file, feature_set, cls_name, cache=cache, workers=workers, feats_dir=feats_dir, hasher=hasher)
     else:
         model = get_classifier(cls_fname)
 
@@ -127,7 +242,12 @@ def train_eval(train_file, feature_set, cls_name, cls_fname, eval_file=None, is_
     if model:
         # evaluate the model
         if eval_file is not None:
-            features_data, texts = build_features(eval_file, feature_set, binning=False)
+            if isinstance(model, MatrixClassifier):
+                features_data, texts = build_features(eval_file, feature_set, binning=False, cache=cache, workers=workers,
+                                                      as_matrix=True, vocabulary=model.vocabulary, feats_dir=feats_dir)
+            else:
+                features_data, texts = build_features(eval_file, feature_set, binning=False, cache=cache, workers=workers,
+                                                      feats_dir=feats_dir)
             accuracy, cm = evaluate(model, features_data, texts, data_set_name=None)
             print("The accuracy of {} is: {}".format(eval_file, accuracy))
             print("Confusion Matrix:")
@@ -153,6 +273,11 @@ if __name__ == '__main__':
     parser.add_argument('-o', dest="output_fname", default="nb-word_features-test.txt", help='Output file name.')
     parser.add_argument('-f', dest="feature_set", default="word_features",
                         help='Feature set: word_features, word_pos_features, etc')
+    parser.add_argument('-cache', dest="cache_fname", default=None, help='File to cache extracted features in between runs')
+    parser.add_argument('-workers', dest="workers", type=int, default=1, help='Number of processes to extract features with')
+    parser.add_argument('-feats', dest="feats_dir", default=None, help='Directory to save extracted feature sets in and load them from in later runs')
+    parser.add_argument('-hash', dest="hash_features", type=int, default=None,
+                        help='Hash the features of the sklearn classifiers into this many columns instead of keeping a vocabulary')
 
     args = parser.parse_args()
 
@@ -165,7 +290,17 @@ if __name__ == '__main__':
     output_fname = args.output_fname
     feature_set = args.feature_set
 
-    train_eval(train_fname, feature_set, classifier_type, classifier_fname, eval_file=eval_fname, is_train=is_train)
+    cache = FeatureCache(args.cache_fname, FEATURES_VERSION) if args.cache_fname is not None else None
+    hasher = None
+    if args.hash_features is not None:
+        # BernoulliNB treats negative values as absent, so it gets unsigned hashing
+        hasher = FeatureHasher(args.hash_features, signed=classifier_type != "nb_sklearn")
+
+    train_eval(train_fname, feature_set, classifier_type, classifier_fname, eval_file=eval_fname, is_train=is_train, cache=cache, workers=args.workers,
+               feats_dir=args.feats_dir, hasher=hasher)
+
+    if cache is not None:
+        cache.close()
 
 
 
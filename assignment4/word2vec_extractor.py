@@ -1,31 +1,577 @@
 import numpy as np
+import scipy.sparse
 import nltk
 import string
 from nltk.corpus import stopwords
-import gensim
+import os, struct, argparse, hashlib, zlib
 import time
+try:
+    import gensim
+except ImportError:
+    gensim = None
 
 
 
 stops = set(stopwords.words("english"))
 punct = set(string.punctuation)
 
+STORE_SUFFIX = '.store'
+# The row of a pruned store holding the mean vector of the words pruned away
+OOV_WORD = '<oov>'
+
+
+def doc_words(doc):
+    """
+    :return: generator of the words of doc that get a vector, i.e. the
+        tokens that are not stopwords or punctuation
+    """
+    for sentence in nltk.sent_tokenize(doc):
+        for word in nltk.word_tokenize(sentence):
+            if word not in stops and word not in punct:
+                yield word
+
+
+def corpus_vocabulary(filenames):
+    """
+    :return: the set of doc_words() of the lines of the corpus files
+    """
+    vocabulary = set()
+    for filename in filenames:
+        with open(filename, 'rb') as fin:
+            for line in fin:
+                vocabulary.update(doc_words(line.decode("latin1")))
+    return vocabulary
+
+
+class EmbeddingStore:
+    """
+    Word vectors in a binary file that is memory mapped rather than parsed:
+    a header, the float32 or float16 matrix with a row per word and the
+    words, one per line. Processes that open the same store share its pages.
+    Supports the part of gensim's KeyedVectors the extractor uses:
+    vector_size, `word in store` and store[word].
+    """
+
+    MAGIC = b'W2VSTOR\0'
+    # magic, rows, columns, bytes per value, offset of the words
+    HEADER = struct.Struct('<8sQQQQ')
+    DTYPES = {4: np.float32, 2: np.float16}
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fin:
+            magic, rows, columns, itemsize, words_offset = self.HEADER.unpack(fin.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError("{} is not an embedding store".format(filename))
+            fin.seek(words_offset)
+            words = fin.read().decode("utf-8").split("\n")[:rows]
+        self.vector_size = columns
+        self.key_to_index = dict(zip(words, range(rows)))
+        self.words = words
+        if rows > 0:
+            self.vectors = np.memmap(filename, dtype=self.DTYPES[itemsize], mode='r', offset=self.HEADER.size, shape=(rows, columns))
+        else:
+            self.vectors = np.zeros((0, columns), dtype=self.DTYPES[itemsize])
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.key_to_index
+
+    def __getitem__(self, word):
+        return self.vectors[self.key_to_index[word]]
+
+    def __reduce__(self):
+        return (EmbeddingStore, (self.filename,))
+
+    @property
+    def oov_row(self):
+        """
+        The row of the OOV_WORD vector in a pruned store, else None
+        """
+        return self.key_to_index.get(OOV_WORD)
+
+    @staticmethod
+    def write(store_filename, word_vectors, dtype=np.float32):
+        """
+        Writes a store from an iterable of (word, vector) one vector at a time.
+        """
+        dtype = np.dtype(dtype)
+        words = []
+        columns = 0
+        with open(store_filename, 'wb') as fout:
+            fout.write(b'\0' * EmbeddingStore.HEADER.size)
+            for word, vector in word_vectors:
+                words.append(word)
+                columns = len(vector)
+                fout.write(np.asarray(vector, dtype=dtype).tobytes())
+            words_offset = fout.tell()
+            fout.write("\n".join(words).encode("utf-8"))
+            fout.seek(0)
+            fout.write(EmbeddingStore.HEADER.pack(EmbeddingStore.MAGIC, len(words), columns, dtype.itemsize, words_offset))
+        return store_filename
+
+    @staticmethod
+    def read_word2vec_text(w2v_filename):
+        """
+        :return: generator of (word, vector) from the word2vec text format:
+            a "<rows> <columns>" line, then a word and its values per line
+        """
+        with open(w2v_filename, 'r', encoding='utf-8') as fin:
+            columns = int(fin.readline().split()[1])
+            for line in fin:
+                fields = line.rstrip().split(' ')
+                if len(fields) == columns + 1:
+                    yield fields[0], np.array(fields[1:], dtype=np.float32)
+
+    @staticmethod
+    def convert(w2v_filename, store_filename=None, dtype=np.float32):
+        """
+        Converts word vectors in the word2vec text format one line at a time.
+
+        :return: the store's filename, w2v_filename + ".store" by default
+        """
+        if store_filename is None:
+            store_filename = w2v_filename + STORE_SUFFIX
+        return EmbeddingStore.write(store_filename, EmbeddingStore.read_word2vec_text(w2v_filename), dtype)
+
+    @staticmethod
+    def prune(source_filename, vocabulary, store_filename, dtype=np.float32):
+        """
+        Writes a store with just the vectors of the words in vocabulary, from a
+        word2vec text file or a store, followed by an OOV_WORD row holding the
+        mean vector of all the words left out.
+
+        :return: store_filename
+        """
+        if source_filename.endswith(STORE_SUFFIX):
+            source = EmbeddingStore(source_filename)
+            word_vectors = zip(source.words, source.vectors)
+            columns = source.vector_size
+        else:
+            word_vectors = EmbeddingStore.read_word2vec_text(source_filename)
+            with open(source_filename, 'r', encoding='utf-8') as fin:
+                columns = int(fin.readline().split()[1])
+        def kept():
+            n_pruned = 0
+            pruned_sum = None
+            for word, vector in word_vectors:
+                if word == OOV_WORD:
+                    continue
+                if word in vocabulary:
+                    yield word, vector
+                else:
+                    n_pruned += 1
+                    pruned_sum = np.asarray(vector, dtype=np.float64) if pruned_sum is None else pruned_sum + vector
+            if n_pruned:
+                yield OOV_WORD, pruned_sum / n_pruned
+            elif columns:
+                yield OOV_WORD, np.zeros(columns)
+
+        return EmbeddingStore.write(store_filename, kept(), dtype)
+
+
+def load_word_vectors(w2vecmodel):
+    """
+    Uses the EmbeddingStore made from w2vecmodel when it is at least as new,
+    the word2vec text file with gensim otherwise. w2vecmodel can also name
+    the store itself.
+    """
+    store_filename = w2vecmodel + STORE_SUFFIX
+    if w2vecmodel.endswith(STORE_SUFFIX):
+        return EmbeddingStore(w2vecmodel)
+    if os.path.exists(store_filename) and os.path.getmtime(store_filename) >= os.path.getmtime(w2vecmodel):
+        return EmbeddingStore(store_filename)
+    if gensim is None:
+        raise ImportError("loading {} needs gensim, or convert it with: python word2vec_extractor.py --convert {}".format(w2vecmodel, w2vecmodel))
+    return gensim.models.KeyedVectors.load_word2vec_format(w2vecmodel)
+
+
+class CorpusStats:
+    """
+    Word statistics of a training corpus for weighted pooling, indexed by the
+    rows of the word vectors: how many documents each word occurs in and how
+    often it occurs, plus the first principal component of the corpus' SIF
+    embeddings. Saved as a .npz file along with a digest of the documents
+    they were computed from.
+    """
+
+    def __init__(self, n_docs, doc_freq, word_freq, principal_component=None, digest=""):
+        self.n_docs = n_docs
+        self.doc_freq = doc_freq
+        self.word_freq = word_freq
+        self.n_words = int(word_freq.sum())
+        self.principal_component = principal_component
+        self.digest = digest
+
+    @staticmethod
+    def docs_digest(docs):
+        digest = hashlib.sha1()
+        for doc in docs:
+            digest.update(doc.encode("utf-8"))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def _counts(counts, rows):
+        # rows past the counts, i.e. words given a vector by a SubwordTable, were never seen
+        found = np.zeros(len(rows))
+        inside = rows < len(counts)
+        found[inside] = counts[rows[inside]]
+        return found
+
+    def idf(self, rows):
+        """
+        Smoothed inverse document frequency, log((1 + n) / (1 + df)) + 1
+        """
+        return np.log((1.0 + self.n_docs) / (1.0 + self._counts(self.doc_freq, rows))) + 1.0
+
+    def sif(self, rows, a=1e-3):
+        """
+        Smooth inverse frequency, a / (a + p(word))
+        """
+        return a / (a + self._counts(self.word_freq, rows) / max(self.n_words, 1))
+
+    def save(self, filename):
+        principal_component = self.principal_component if self.principal_component is not None else np.zeros(0)
+        with open(filename, 'wb') as fout:
+            np.savez(fout, n_docs=self.n_docs, doc_freq=self.doc_freq, word_freq=self.word_freq,
+                     principal_component=principal_component, digest=self.digest)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as stats:
+            principal_component = stats["principal_component"] if stats["principal_component"].size else None
+            return CorpusStats(int(stats["n_docs"]), stats["doc_freq"], stats["word_freq"], principal_component, str(stats["digest"]))
+
+
+POOLINGS = ("mean", "tfidf", "sif", "max", "min", "sentence")
+
+
+class VectorIndex:
+    """
+    Cosine similarity search over a set of vectors, e.g. the word vectors or
+    the docs2vec() of a corpus.
+
+    With n_lists=0 every query is compared with all the vectors, a block of
+    rows at a time. Otherwise the vectors are clustered into n_lists lists
+    with k-means (an IVF index) and a query is only compared with the
+    vectors of the n_probe lists whose centroids are closest to it, which is
+    approximate but much faster for large vocabularies.
+
+    :param vectors: array of shape (n, dimensions)
+    :param labels: a label (word, document id...) per vector
+    :param n_lists: the number of lists, None picks 0 for up to EXACT_SIZE
+        vectors and about 4 * sqrt(n) above that
+    """
+
+    EXACT_SIZE = 50000
+
+    def __init__(self, vectors, labels=None, n_lists=None, iterations=10, sample_size=100000, seed=10):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.where(norms > 0, norms, 1.0)
+        self.labels = list(labels) if labels is not None else list(range(len(vectors)))
+        if n_lists is None:
+            n_lists = 0 if len(vectors) <= self.EXACT_SIZE else int(4 * np.sqrt(len(vectors)))
+        n_lists = min(n_lists, len(vectors))
+        self.centroids = np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+        self.list_order = np.zeros(0, dtype=np.int64)
+        self.list_indptr = np.zeros(1, dtype=np.int64)
+        if n_lists > 0:
+            self._build_lists(n_lists, iterations, sample_size, np.random.RandomState(seed))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def _nearest(queries, targets, k, block_size=4096):
+        """
+        :return: (indices, scores) of the k targets with the highest dot
+            product with each query, best first, computed block_size targets
+            at a time
+        """
+        k = min(k, len(targets))
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(targets), block_size):
+            scores = queries @ targets[start:start + block_size].T
+            if k == 1:
+                top = np.argmax(scores, axis=1)[:, np.newaxis]
+                scores = np.take_along_axis(scores, top, axis=1)
+                indices = top + start
+                if best_scores.shape[1] > 0:
+                    better = scores > best_scores
+                    scores = np.where(better, scores, best_scores)
+                    indices = np.where(better, indices, best_indices)
+                best_scores, best_indices = scores, indices
+                continue
+            indices = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            scores = np.hstack([best_scores, scores])
+            indices = np.hstack([best_indices, indices])
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                indices = np.take_along_axis(indices, top, axis=1)
+            best_scores, best_indices = scores, indices
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def _build_lists(self, n_lists, iterations, sample_size, random_state):
+        sample = self.vectors
+        if len(sample) > sample_size:
+            sample = sample[np.sort(random_state.choice(len(sample), sample_size, replace=False))]
+        centroids = sample[random_state.choice(len(sample), n_lists, replace=False)]
+        for iteration in range(iterations):
+            assignments = self._nearest(sample, centroids, 1)[0][:, 0]
+            members = scipy.sparse.csr_matrix((np.ones(len(sample), dtype=np.float32), assignments, np.arange(len(sample) + 1)),
+                                              shape=(len(sample), n_lists))
+            sums = np.asarray(members.T @ sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # a list that lost all its vectors keeps its old centroid
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1.0), centroids)
+        assignments = self._nearest(self.vectors, centroids, 1)[0][:, 0]
+        self.centroids = centroids
+        self.list_order = np.argsort(assignments, kind="stable")
+        self.list_indptr = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    def search(self, queries, k=10, n_probe=8):
+        """
+        :param queries: array of shape (n_queries, dimensions), or one vector
+        :param n_probe: the number of lists to search in an IVF index
+        :return: (indices, scores): arrays of shape (n_queries, k) of the
+            nearest vectors, best first, and their cosine similarities; an
+            IVF search that finds fewer than k vectors pads with -1 and -inf
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1.0)
+        if len(self.centroids) == 0:
+            return self._nearest(queries, self.vectors, k)
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        lists = self._nearest(queries, self.centroids, n_probe)[0]
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self.list_order[self.list_indptr[j]:self.list_indptr[j + 1]] for j in lists[i]])
+            if len(candidates) == 0:
+                continue
+            found, found_scores = self._nearest(query[np.newaxis], self.vectors[candidates], k)
+            indices[i, :found.shape[1]] = candidates[found[0]]
+            scores[i, :found.shape[1]] = found_scores[0]
+        return indices, scores
+
+    def most_similar(self, vector, k=10, n_probe=8):
+        """
+        :return: [(label, cosine similarity)] of the k nearest vectors
+        """
+        indices, scores = self.search(vector, k, n_probe)
+        return [(self.labels[i], float(score)) for i, score in zip(indices[0], scores[0]) if i >= 0]
+
+    def save(self, filename):
+        with open(filename, 'wb') as fout:
+            np.savez(fout, vectors=self.vectors, labels=np.array(self.labels), centroids=self.centroids,
+                     list_order=self.list_order, list_indptr=self.list_indptr)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as saved:
+            index = VectorIndex.__new__(VectorIndex)
+            index.vectors = saved["vectors"]
+            index.labels = saved["labels"].tolist()
+            index.centroids = saved["centroids"]
+            index.list_order = saved["list_order"]
+            index.list_indptr = saved["list_indptr"]
+        return index
+
+
+def index_words(w2vecmodel):
+    """
+    :return: the word of each row of w2vecmodel.vectors
+    """
+    if hasattr(w2vecmodel, "index_to_key"):
+        return w2vecmodel.index_to_key
+    if hasattr(w2vecmodel, "index2word"):
+        return w2vecmodel.index2word
+    return w2vecmodel.words
+
+
+SUBWORDS_SUFFIX = '.subwords'
+
+
+def char_ngrams(word, min_n=3, max_n=5):
+    """
+    :return: generator of the character n-grams of "<word>"
+    """
+    word = "<" + word + ">"
+    for n in range(min_n, max_n + 1):
+        for i in range(len(word) - n + 1):
+            yield word[i:i + n]
+
+
+class SubwordTable:
+    """
+    Vectors for words that have none, from their character n-grams: each
+    n-gram is hashed (CRC32) into one of n_buckets buckets holding the mean
+    vector of the known words with an n-gram in that bucket, and a word gets
+    the mean of the buckets of its n-grams, in time linear in its length.
+    Built once from the word vectors with build() and memory mapped, like
+    EmbeddingStore.
+    """
+
+    MAGIC = b'W2VSUBW\0'
+    # magic, buckets, columns, min_n, max_n
+    HEADER = struct.Struct('<8sQQQQ')
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fin:
+            magic, n_buckets, columns, self.min_n, self.max_n = self.HEADER.unpack(fin.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError("{} is not a subword table".format(filename))
+        self.n_buckets = n_buckets
+        self.counts = np.memmap(filename, dtype=np.int64, mode='r', offset=self.HEADER.size, shape=(n_buckets,))
+        self.vectors = np.memmap(filename, dtype=np.float32, mode='r', offset=self.HEADER.size + 8 * n_buckets,
+                                 shape=(n_buckets, columns))
+
+    def __reduce__(self):
+        return (SubwordTable, (self.filename,))
+
+    def buckets(self, word):
+        return [zlib.crc32(ngram.encode("utf-8")) % self.n_buckets for ngram in char_ngrams(word, self.min_n, self.max_n)]
+
+    def vector(self, word):
+        """
+        :return: the mean vector of the non-empty buckets of word's n-grams,
+            or None when they are all empty
+        """
+        buckets = [bucket for bucket in self.buckets(word) if self.counts[bucket] > 0]
+        if not buckets:
+            return None
+        return np.asarray(self.vectors[buckets], dtype=np.float64).mean(axis=0)
+
+    @staticmethod
+    def build(w2vecmodel, filename, n_buckets=2 ** 16, min_n=3, max_n=5, chunk_size=10000):
+        """
+        :param w2vecmodel: an EmbeddingStore or gensim KeyedVectors
+        :return: filename
+        """
+        words = index_words(w2vecmodel)
+        columns = w2vecmodel.vector_size
+        counts = np.zeros(n_buckets, dtype=np.int64)
+        sums = np.zeros((n_buckets, columns))
+        for start in range(0, len(words), chunk_size):
+            chunk = words[start:start + chunk_size]
+            buckets = []
+            word_columns = []
+            for i, word in enumerate(chunk):
+                if word == OOV_WORD:
+                    continue
+                for ngram in char_ngrams(word, min_n, max_n):
+                    buckets.append(zlib.crc32(ngram.encode("utf-8")) % n_buckets)
+                    word_columns.append(i)
+            members = scipy.sparse.csr_matrix((np.ones(len(buckets)), (buckets, word_columns)), shape=(n_buckets, len(chunk)))
+            sums += members @ np.asarray(w2vecmodel.vectors[start:start + len(chunk)], dtype=np.float64)
+            counts += np.bincount(np.asarray(buckets, dtype=np.int64), minlength=n_buckets)
+        means = sums / np.maximum(counts, 1)[:, np.newaxis]
+        with open(filename, 'wb') as fout:
+            fout.write(SubwordTable.HEADER.pack(SubwordTable.MAGIC, n_buckets, columns, min_n, max_n))
+            fout.write(counts.tobytes())
+            fout.write(means.astype(np.float32).tobytes())
+        return filename
+
+
+def word_rows(w2vecmodel):
+    """
+    :return: word -> row of w2vecmodel.vectors, for an EmbeddingStore or
+        gensim KeyedVectors (key_to_index in gensim 4, vocab before)
+    """
+    if hasattr(w2vecmodel, "key_to_index"):
+        return w2vecmodel.key_to_index
+    return {word: vocab.index for word, vocab in w2vecmodel.vocab.items()}
+
+
 class Word2vecExtractor:
 
-    def __init__(self, w2vecmodel):
+    def __init__(self, w2vecmodel, use_oov=False, subwords=False):
+        """
+        :param w2vecmodel: a word2vec text file or an EmbeddingStore file,
+            which may be a pruned one
+        :param use_oov: give words without a vector the OOV_WORD vector of a
+            pruned store instead of skipping them
+        :param subwords: give words without a vector the vector of their
+            lowercase form, or else one from their character n-grams with the
+            SubwordTable saved as w2vecmodel + ".subwords" (see --subwords)
+        """
         #self.w2vecmodel=gensim.models.Word2Vec.load_word2vec_format(w2vecmodel, binary=binary)
-        self.w2vecmodel = gensim.models.KeyedVectors.load_word2vec_format(w2vecmodel)
+        self.w2vecmodel = load_word_vectors(w2vecmodel)
+        self.word_rows = word_rows(self.w2vecmodel)
+        self.oov_row = getattr(self.w2vecmodel, "oov_row", None) if use_oov else None
+        self.subwords = SubwordTable(w2vecmodel + SUBWORDS_SUFFIX) if subwords else None
+        self._word_index = None
+        self._word_index_args = (None, None)
 
         #self.w2vecmodel = w2vecmodel
 
+    def _row(self, word, subword_rows, subword_vectors):
+        """
+        :param subword_rows: word -> row of the words of a batch without a
+            vector of their own, filled in as they are seen
+        :param subword_vectors: the vectors the subword table gives words of
+            the batch, appended to as they are seen
+        :return: the row of word's vector, see _vectors(), or None
+        """
+        row = self.word_rows.get(word)
+        if row is None and self.subwords is not None:
+            if word not in subword_rows:
+                row = self.word_rows.get(word.lower())
+                if row is None:
+                    vector = self.subwords.vector(word.lower())
+                    if vector is not None:
+                        row = len(self.w2vecmodel.vectors) + len(subword_vectors)
+                        subword_vectors.append(vector)
+                subword_rows[word] = row
+            row = subword_rows[word]
+        if row is None:
+            row = self.oov_row
+        return row
+
+    def _vectors(self, rows, subword_vectors):
+        """
+        :param subword_vectors: array of the vectors of the rows past the
+            word vectors, those given by the subword table, see _rows()
+        :return: the vectors of rows as float64
+        """
+        n_rows = len(self.w2vecmodel.vectors)
+        if len(subword_vectors) == 0 or len(rows) == 0 or rows.max() < n_rows:
+            return np.asarray(self.w2vecmodel.vectors[rows], dtype=np.float64)
+        vectors = np.empty((len(rows), self.w2vecmodel.vector_size))
+        known = rows < n_rows
+        vectors[known] = self.w2vecmodel.vectors[rows[known]]
+        vectors[~known] = subword_vectors[rows[~known] - n_rows]
+        return vectors
+
+    def word_vector(self, word):
+        """
+        :return: word's vector, or None
+        """
+        subword_vectors = []
+        row = self._row(word, {}, subword_vectors)
+        if row is None:
+            return None
+        n_rows = len(self.w2vecmodel.vectors)
+        return self.w2vecmodel.vectors[row] if row < n_rows else subword_vectors[row - n_rows]
+
     def sen2vec(self,sentence):
         words = [word for word in nltk.word_tokenize(sentence) if word not in stops and word not in punct]
         res = np.zeros(self.w2vecmodel.vector_size)
         count = 0
         for word in words:
-            if word in self.w2vecmodel:
+            vector = self.word_vector(word)
+            if vector is not None:
                 count += 1
-                res += self.w2vecmodel[word]
+                res += vector
 
         if count != 0:
             res /= count
@@ -38,15 +584,153 @@ class Word2vecExtractor:
         for sentence in nltk.sent_tokenize(doc):
             for word in nltk.word_tokenize(sentence):
                 if((word not in stops) and (word not in punct)):
-                    if word in self.w2vecmodel:
+                    vector = self.word_vector(word)
+                    if vector is not None:
                         count += 1
-                        res += self.w2vecmodel[word]
+                        res += vector
 
         if count != 0:
             res /= count
 
         return res 
 
+    def _rows(self, docs):
+        """
+        :return: (rows, sentence_indptr, doc_indptr, subword_vectors): the
+            vector rows of the known words of all the documents, where
+            sentence i is rows[sentence_indptr[i]:sentence_indptr[i + 1]] and
+            document j is sentences doc_indptr[j] to doc_indptr[j + 1], and
+            the vectors the subword table gives the words of these documents
+            without one, which get the rows after the word vectors in the
+            order they are first seen
+        """
+        subword_rows = {}
+        subword_vectors = []
+        rows = []
+        sentence_indptr = [0]
+        doc_indptr = [0]
+        for doc in docs:
+            for sentence in nltk.sent_tokenize(doc):
+                for word in nltk.word_tokenize(sentence):
+                    if word not in stops and word not in punct:
+                        row = self._row(word, subword_rows, subword_vectors)
+                        if row is not None:
+                            rows.append(row)
+                sentence_indptr.append(len(rows))
+            doc_indptr.append(len(sentence_indptr) - 1)
+        subword_vectors = np.array(subword_vectors).reshape(len(subword_vectors), self.w2vecmodel.vector_size)
+        return (np.asarray(rows, dtype=np.int64), np.asarray(sentence_indptr, dtype=np.int64), np.asarray(doc_indptr, dtype=np.int64),
+                subword_vectors)
+
+    def _weighted_means(self, rows, indptr, subword_vectors, weights=None):
+        """
+        The weighted mean of the vectors of each segment rows[indptr[i]:indptr[i + 1]],
+        as one sparse (segments x words) by (words x dimensions) product over
+        just the rows that occur; empty segments are zero.
+        """
+        if weights is None:
+            weights = np.ones(len(rows))
+        used_rows, columns = np.unique(rows, return_inverse=True)
+        segments = scipy.sparse.csr_matrix((weights, columns, indptr), shape=(len(indptr) - 1, len(used_rows)))
+        sums = segments @ self._vectors(used_rows, subword_vectors)
+        totals = np.asarray(segments.sum(axis=1)).ravel()
+        return sums / np.where(totals > 0, totals, 1.0)[:, np.newaxis]
+
+    def _extreme(self, rows, indptr, subword_vectors, reduce, chunk_size=100000):
+        """
+        reduce (np.maximum or np.minimum) over the vectors of each segment,
+        gathering at most about chunk_size vectors at a time
+        """
+        res = np.zeros((len(indptr) - 1, self.w2vecmodel.vector_size))
+        nonempty = np.flatnonzero(np.diff(indptr))
+        start = 0
+        while start < len(nonempty):
+            end = start + 1
+            while end < len(nonempty) and indptr[nonempty[end] + 1] - indptr[nonempty[start]] <= chunk_size:
+                end += 1
+            segments = nonempty[start:end]
+            first = indptr[segments[0]]
+            vectors = self._vectors(rows[first:indptr[segments[-1] + 1]], subword_vectors)
+            res[segments] = reduce.reduceat(vectors, indptr[segments] - first, axis=0)
+            start = end
+        return res
+
+    def docs2vec(self, docs, pooling="mean", stats=None):
+        """
+        The doc2vec() of many documents at once: the words of all of them are
+        mapped to rows of the vectors first, then the document vectors are
+        computed in one go. Pooling is one of POOLINGS:
+
+        * mean: the mean of the word vectors, as doc2vec()
+        * tfidf: the mean weighted by each word's idf, repeated words count
+          once per occurrence
+        * sif: the mean weighted by a / (a + p(word)), minus the projection on
+          the corpus' first principal component when stats has one
+        * max, min: the elementwise maximum or minimum of the word vectors
+        * sentence: the mean of the sen2vec() of each sentence
+
+        :param stats: the CorpusStats that tfidf and sif need, see corpus_stats()
+        :return: array of shape (len(docs), vector_size)
+        """
+        if pooling not in POOLINGS:
+            raise ValueError("unknown pooling {}, expected one of {}".format(pooling, POOLINGS))
+        if pooling in ("tfidf", "sif") and stats is None:
+            raise ValueError("{} pooling needs the corpus stats".format(pooling))
+
+        rows, sentence_indptr, doc_indptr, subword_vectors = self._rows(docs)
+        word_indptr = sentence_indptr[doc_indptr]
+
+        if pooling == "mean":
+            return self._weighted_means(rows, word_indptr, subword_vectors)
+        if pooling == "tfidf":
+            return self._weighted_means(rows, word_indptr, subword_vectors, stats.idf(rows))
+        if pooling == "sif":
+            res = self._weighted_means(rows, word_indptr, subword_vectors, stats.sif(rows))
+            if stats.principal_component is not None:
+                res -= np.outer(res @ stats.principal_component, stats.principal_component)
+            return res
+        if pooling == "max":
+            return self._extreme(rows, word_indptr, subword_vectors, np.maximum)
+        if pooling == "min":
+            return self._extreme(rows, word_indptr, subword_vectors, np.minimum)
+
+        sentence_vectors = self._weighted_means(rows, sentence_indptr, subword_vectors)
+        sentence_columns = np.arange(len(sentence_indptr) - 1)
+        docs_sentences = scipy.sparse.csr_matrix((np.ones(len(sentence_columns)), sentence_columns, doc_indptr),
+                                                 shape=(len(doc_indptr) - 1, len(sentence_columns)))
+        totals = np.diff(doc_indptr)
+        return (docs_sentences @ sentence_vectors) / np.maximum(totals, 1)[:, np.newaxis]
+
+    def corpus_stats(self, docs, filename=None):
+        """
+        Computes the CorpusStats of the (training) documents, or loads them
+        from filename when they were saved there for the same documents.
+        """
+        docs = list(docs)
+        digest = CorpusStats.docs_digest(docs)
+        if filename is not None and os.path.exists(filename):
+            stats = CorpusStats.load(filename)
+            if stats.digest == digest and len(stats.word_freq) == len(self.w2vecmodel.vectors):
+                return stats
+
+        rows, sentence_indptr, doc_indptr, subword_vectors = self._rows(docs)
+        word_indptr = sentence_indptr[doc_indptr]
+        n_rows = len(self.w2vecmodel.vectors)
+        # words given a vector by the subword table have no stable row to count them under
+        known = rows < n_rows
+        word_freq = np.bincount(rows[known], minlength=n_rows)
+        doc_ids = np.repeat(np.arange(len(docs)), np.diff(word_indptr))[known]
+        doc_words = np.unique(doc_ids * n_rows + rows[known]) % n_rows
+        doc_freq = np.bincount(doc_words, minlength=n_rows)
+        stats = CorpusStats(len(docs), doc_freq, word_freq, digest=digest)
+
+        if len(docs) > 1:
+            sif_vectors = self._weighted_means(rows, word_indptr, subword_vectors, stats.sif(rows))
+            stats.principal_component = np.linalg.svd(sif_vectors, full_matrices=False)[2][0]
+        if filename is not None:
+            stats.save(filename)
+        return stats
+
     def get_doc2vec_feature_dict(self, doc):  
         vec = self.doc2vec(doc)
 
@@ -57,16 +741,134 @@ class Word2vecExtractor:
             feature_dict.update({"Word2Vecfeature_"+ str(i):vec[i]})
            
         return feature_dict
+
+    def feature_names(self):
+        """
+        :return: the names of the get_doc2vec_feature_dict() features, in
+            the order of the vector dimensions
+        """
+        return ["Word2Vecfeature_" + str(i) for i in range(self.w2vecmodel.vector_size)]
+
+    def get_docs2vec_feature_dicts(self, docs):
+        """
+        get_doc2vec_feature_dict() for many documents, see docs2vec()
+        """
+        names = self.feature_names()
+        return [dict(zip(names, vec)) for vec in self.docs2vec(docs)]
     
+    def word_index(self, n_lists=None, filename=None):
+        """
+        A VectorIndex over the word vectors, without the OOV_WORD row of a
+        pruned store. It is built on first use, or loaded from filename when
+        it was saved there for the same words, and kept for later calls that
+        do not ask for another n_lists or filename.
+        """
+        index = self._word_index
+        if index is not None and (n_lists is None or n_lists == self._word_index_args[0]) \
+                and (filename is None or filename == self._word_index_args[1]):
+            return index
+
+        words = index_words(self.w2vecmodel)
+        rows = [row for row, word in enumerate(words) if word != OOV_WORD]
+        labels = [words[row] for row in rows]
+        index = None
+        if filename is not None and os.path.exists(filename):
+            index = VectorIndex.load(filename)
+            # an index saved for other vectors, or with other lists, is rebuilt
+            if index.labels != labels or (n_lists is not None and len(index.centroids) != min(n_lists, len(labels))):
+                index = None
+        if index is None:
+            vectors = self.w2vecmodel.vectors
+            if len(rows) < len(words):
+                vectors = vectors[rows]
+            index = VectorIndex(vectors, labels, n_lists=n_lists)
+            if filename is not None:
+                index.save(filename)
+        self._word_index = index
+        self._word_index_args = (n_lists, filename)
+        return index
+
+    def most_similar_words(self, word, k=10, n_probe=8):
+        """
+        :return: [(word, cosine similarity)] of the k words nearest to word
+        """
+        if word not in self.word_rows or word == OOV_WORD:
+            return []
+        similar = self.word_index().most_similar(self.w2vecmodel[word], k + 1, n_probe)
+        return [(other, score) for other, score in similar if other != word][:k]
+
+    def expand_lexicon(self, words, k=10, min_similarity=0.6, n_probe=8):
+        """
+        Adds the nearest neighbours of each word of a lexicon, e.g. the opinion
+        lexicon, that are at least min_similarity to it.
+
+        :return: set of words
+        """
+        words = set(words)
+        known = [word for word in words if word in self.word_rows and word != OOV_WORD]
+        if not known:
+            return words
+        index = self.word_index()
+        indices, scores = index.search(np.array([self.w2vecmodel[word] for word in known]), k + 1, n_probe)
+        expanded = set(words)
+        for row_indices, row_scores in zip(indices, scores):
+            expanded.update(index.labels[i] for i, score in zip(row_indices, row_scores) if i >= 0 and score >= min_similarity)
+        return expanded
+
+    def doc_index(self, docs, labels=None, pooling="mean", stats=None, n_lists=None):
+        """
+        :return: a VectorIndex over the docs2vec() of docs, query it with
+            docs2vec() vectors of other documents
+        """
+        return VectorIndex(self.docs2vec(docs, pooling, stats), labels, n_lists=n_lists)
+
     def word2v(self, word):
         res = np.zeros(self.w2vecmodel.vector_size)
-        if word in self.w2vecmodel:
-            res += self.w2vecmodel[word]
+        vector = self.word_vector(word)
+        if vector is not None:
+            res += vector
         return res
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Word2vec feature extractor')
+    parser.add_argument('--convert', dest="convert_fname", default=None,
+                        help='Convert a word2vec text file to an EmbeddingStore next to it and exit')
+    parser.add_argument('--prune', dest="prune_fname", default=None,
+                        help='Write a store of just the words of the --corpus files from this word2vec text file or store and exit')
+    parser.add_argument('--corpus', dest="corpus_fnames", nargs='+', default=["asg4-data/data/imdb-training.data",
+                        "asg4-data/data/imdb-development.data", "asg4-data/data/imdb-testing.data"], help='The corpora to --prune for')
+    parser.add_argument('-o', dest="output_fname", default=None, help='The pruned store, <--prune file>.pruned.store by default')
+    parser.add_argument('--subwords', dest="subwords_fname", default=None,
+                        help='Build the SubwordTable of a word2vec text file or store next to it and exit')
+    parser.add_argument('--float16', dest="float16", action="store_true", help='Store the vectors as float16')
+    args = parser.parse_args()
+    dtype = np.float16 if args.float16 else np.float32
+
+    if args.convert_fname is not None:
+        t0 = time.time()
+        store_fname = EmbeddingStore.convert(args.convert_fname, dtype=dtype)
+        print("wrote {} in {:.1f}s".format(store_fname, time.time() - t0))
+        raise SystemExit
+
+    if args.subwords_fname is not None:
+        t0 = time.time()
+        table_fname = SubwordTable.build(load_word_vectors(args.subwords_fname), args.subwords_fname + SUBWORDS_SUFFIX)
+        print("wrote {} in {:.1f}s".format(table_fname, time.time() - t0))
+        raise SystemExit
+
+    if args.prune_fname is not None:
+        t0 = time.time()
+        output_fname = args.output_fname
+        if output_fname is None:
+            output_fname = (args.prune_fname[:-len(STORE_SUFFIX)] if args.prune_fname.endswith(STORE_SUFFIX) else args.prune_fname) + ".pruned" + STORE_SUFFIX
+        vocabulary = corpus_vocabulary(args.corpus_fnames)
+        EmbeddingStore.prune(args.prune_fname, vocabulary, output_fname, dtype=dtype)
+        print("wrote {} with {} of the {} corpus words in {:.1f}s".format(output_fname, len(EmbeddingStore(output_fname)) - 1,
+                                                                         len(vocabulary), time.time() - t0))
+        raise SystemExit
+
     t0 = time.time()
     glove_w2v_file = "asg4-data/glove-w2v.txt"
     W2vecextractor = Word2vecExtractor(glove_w2v_file)